@@ -1,50 +1,242 @@
 # https://learn.microsoft.com/en-us/rest/api/compute/resource-skus/list?view=rest-compute-2024-03-01&tabs=HTTP
-# pip install azure-identity azure-mgmt-compute pandas
+# pip install azure-identity aiohttp
 
 '''
 
-This script will have you interactively sign on into Azure with a subscription specified in the script. Then proceed to retrieve all the VM SKUs available
-then export to a CSV file named: "Azure-VM-SKU-List.csv"
+This script will have you interactively sign on into Azure once, then retrieve all the VM SKUs available in every subscription listed
+in the subscription_ids variable (or every subscription the account can access when the list is empty) and export them to a CSV file
+named: "Azure-VM-SKU-List.csv" and an indexed SQLite table named: "Azure-VM-SKU-Index.db"
 
-***Remember to update the subscription_id variable below.
+The subscriptions are queried concurrently (up to max_concurrency at a time) with asyncio and every page of results is retrieved by
+following nextLink. One access token is shared by every request and the sign in is saved to a persistent token cache together with
+an authentication record (authentication_record_file), so later runs sign in silently without opening the browser.
+
+Most subscriptions return identical SKU records, so identical records are only kept once and memory grows with the number of unique
+SKUs rather than subscriptions x SKUs. Records of the same SKU that differ between subscriptions (usually in their restrictions) are
+merged into one row per SKU and location: restrictions lists the reasons of every subscription, and locationRestrictions is only set
+when the SKU is restricted in the whole location in every subscription, so a SKU that one of the subscriptions can deploy is kept.
+
+Only records with resourceType virtualMachines are kept, filtered on the raw records as they arrive. Each SKU is flattened into one row
+per location and the name/value capabilities are pivoted into typed columns (e.g. vCPUs, MemoryGB, MaxDataDiskCount, PremiumIO) so the
+SKUs can be queried directly, for example:
+
+SELECT name, vCPUs, MemoryGB FROM vm_skus WHERE location = 'canadacentral' AND vCPUs >= 8 AND PremiumIO = 1
+
+To test against a local mock ARM server, set the ARM_ENDPOINT environment variable to the mock server URL (e.g. http://localhost:8080)
+and ARM_ACCESS_TOKEN to any value to skip the sign in.
+
+***Remember to update the subscription_ids variable below.
 
 '''
 
-# Replace 'your_subscription_id' with your Azure subscription ID
-subscription_id = 'xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxx'
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import aiohttp
+from azure.identity import AuthenticationRecord, InteractiveBrowserCredential, TokenCachePersistenceOptions
+
+# Replace with your Azure subscription IDs, leave the list empty to retrieve the SKUs of every subscription the account can access
+subscription_ids = ['xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxx']
+
+# Maximum number of subscriptions queried at the same time
+max_concurrency = 16
+
+# Authentication record of the last interactive sign in, used to sign in silently from the persistent token cache
+authentication_record_file = 'Azure-Auth-Record.json'
+
+# Azure Resource Manager endpoint and an optional fixed access token (used to test against a local mock ARM server)
+arm_endpoint = os.environ.get('ARM_ENDPOINT', 'https://management.azure.com')
+arm_access_token = os.environ.get('ARM_ACCESS_TOKEN')
+
+arm_scope = 'https://management.azure.com/.default'
+
+# Output files
+output_csv_file = 'Azure-VM-SKU-List.csv'
+output_db_file = 'Azure-VM-SKU-Index.db'
+
+# One access token shared by every request, refreshed only when it is about to expire
+class TokenProvider:
+    def __init__(self):
+        self.credential = None
+        self.token = None
+        self.lock = asyncio.Lock()
+
+    # Interactive login the first time, silent login from the persistent token cache afterwards
+    def create_credential(self):
+        cache_options = TokenCachePersistenceOptions(name='Get-Azure-VM-SKUs')
+        if os.path.exists(authentication_record_file):
+            with open(authentication_record_file, 'r') as file:
+                record = AuthenticationRecord.deserialize(file.read())
+            return InteractiveBrowserCredential(cache_persistence_options=cache_options, authentication_record=record)
+
+        credential = InteractiveBrowserCredential(cache_persistence_options=cache_options)
+        record = credential.authenticate(scopes=[arm_scope])
+        with open(authentication_record_file, 'w') as file:
+            file.write(record.serialize())
+        return credential
+
+    async def get_token(self):
+        if arm_access_token:
+            return arm_access_token
+        async with self.lock:
+            if self.token is None or self.token.expires_on - time.time() < 300:
+                if self.credential is None:
+                    self.credential = await asyncio.to_thread(self.create_credential)
+                self.token = await asyncio.to_thread(self.credential.get_token, arm_scope)
+            return self.token.token
+
+# Function to send a GET request to Azure Resource Manager, waiting and retrying when the request is throttled
+async def get_json(session, tokens, url, retries=5):
+    for attempt in range(retries + 1):
+        headers = {
+            'Authorization': 'Bearer ' + await tokens.get_token(),
+        }
+        async with session.get(url, headers=headers) as response:
+            if response.status == 429 and attempt < retries:
+                await asyncio.sleep(int(response.headers.get('Retry-After', 2 ** attempt)))
+                continue
+            if response.status != 200:
+                raise RuntimeError(f"Request failed with status code {response.status}: {url}")
+            return await response.json()
+
+# Generator that yields every item of an Azure Resource Manager list, following nextLink page by page
+async def iter_list(session, tokens, url):
+    while url:
+        data = await get_json(session, tokens, url)
+        for item in data['value']:
+            yield item
+        url = data.get('nextLink')
+
+# Function to retrieve the IDs of every subscription the signed in account can access
+async def list_subscriptions(session, tokens):
+    url = f"{arm_endpoint}/subscriptions?api-version=2022-12-01"
+    return [subscription['subscriptionId'] async for subscription in iter_list(session, tokens, url)]
+
+# Function to convert a capability value to a number or boolean when possible ("8" -> 8, "1.5" -> 1.5, "True" -> True)
+def parse_capability(value):
+    if value in ('True', 'False'):
+        return value == 'True'
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+# Function to flatten a VM SKU record into one row per location with its capabilities pivoted into columns
+def flatten_sku(record):
+    capabilities = {capability['name']: parse_capability(capability['value']) for capability in record.get('capabilities', [])}
+    zones = {info['location'].lower(): ','.join(sorted(info.get('zones', []))) for info in record.get('locationInfo', [])}
+    rows = []
+    for location in record.get('locations', []):
+        location = location.lower()
+        # Restrictions on deploying the SKU in this location (type Location) or in some of its zones (type Zone) for the subscription
+        restrictions = [restriction for restriction in record.get('restrictions', [])
+                        if location in [value.lower() for value in restriction.get('restrictionInfo', {}).get('locations', restriction.get('values', []))]]
+        row = {
+            'name': record['name'],
+            'tier': record.get('tier'),
+            'size': record.get('size'),
+            'family': record.get('family'),
+            'location': location,
+            'zones': zones.get(location, ''),
+            'restrictions': ','.join(restriction.get('reasonCode', '') for restriction in restrictions),
+            # Reasons the SKU can not be deployed anywhere in this location, a SKU restricted in only some zones can still be used
+            'locationRestrictions': ','.join(restriction.get('reasonCode', '') for restriction in restrictions if restriction.get('type') == 'Location'),
+        }
+        row.update(capabilities)
+        rows.append(row)
+    return rows
+
+# Function to split a comma-separated list of restriction reasons into a set
+def split_reasons(value):
+    return set(value.split(',')) - {''}
+
+# Function to merge a flattened row into the row of the same SKU and location retrieved from another subscription
+def merge_sku_row(skus, row):
+    key = (row['name'], row['location'])
+    existing = skus.get(key)
+    if existing is None:
+        skus[key] = row
+        return
+    existing['restrictions'] = ','.join(sorted(split_reasons(existing['restrictions']) | split_reasons(row['restrictions'])))
+    # The SKU can be deployed in the location as long as one of the subscriptions is not restricted there
+    if existing['locationRestrictions'] and row['locationRestrictions']:
+        existing['locationRestrictions'] = ','.join(sorted(split_reasons(existing['locationRestrictions']) | split_reasons(row['locationRestrictions'])))
+    else:
+        existing['locationRestrictions'] = ''
 
-from azure.identity import InteractiveBrowserCredential
-import requests
-import pandas as pd
+# Function to retrieve the VM SKUs of one subscription, keeping only one copy of every identical SKU record and one row per SKU and location
+async def fetch_skus(session, tokens, semaphore, subscription_id, unique_skus, skus):
+    url = f"{arm_endpoint}/subscriptions/{subscription_id}/providers/Microsoft.Compute/skus?api-version=2021-07-01"
+    count = 0
+    async with semaphore:
+        try:
+            async for record in iter_list(session, tokens, url):
+                # Filter to only include records where resourceType is virtualMachines before anything else is done with them
+                if record.get('resourceType') != 'virtualMachines':
+                    continue
+                count += 1
+                key = hashlib.sha256(json.dumps(record, sort_keys=True).encode()).digest()
+                if key not in unique_skus:
+                    unique_skus.add(key)
+                    for row in flatten_sku(record):
+                        merge_sku_row(skus, row)
+        except (aiohttp.ClientError, RuntimeError) as e:
+            print(f"Subscription {subscription_id}: {e}")
+            return 0
+    print(f"Subscription {subscription_id}: {count} VM SKUs")
+    return count
 
-# Interactive login
-credential = InteractiveBrowserCredential()
+async def main():
+    tokens = TokenProvider()
+    unique_skus = set()
+    skus = {}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
 
-# Get the access token
-token = credential.get_token('https://management.azure.com/.default')
+    async with aiohttp.ClientSession(connector=connector) as session:
+        subscriptions = subscription_ids or await list_subscriptions(session, tokens)
+        counts = await asyncio.gather(*[fetch_skus(session, tokens, semaphore, subscription_id, unique_skus, skus) for subscription_id in subscriptions])
 
-# Azure API endpoint
-url = "https://management.azure.com/subscriptions/{subscription-id}/providers/Microsoft.Compute/skus?api-version=2021-07-01"
+    print(f"Retrieved {sum(counts)} VM SKU records from {len(subscriptions)} subscriptions, {len(unique_skus)} unique, {len(skus)} SKU locations")
+    return list(skus.values())
 
-# Replace {subscription-id} with your actual subscription ID
-url = url.replace("{subscription-id}", subscription_id)
+# Function to store the flattened SKUs in an indexed SQLite table, each capability column is typed from its values
+def write_sku_index(rows, columns, db_file):
+    column_types = {}
+    for row in rows:
+        for column, value in row.items():
+            if column not in column_types and value is not None:
+                column_types[column] = 'INTEGER' if isinstance(value, (bool, int)) else 'REAL' if isinstance(value, float) else 'TEXT'
 
-# Set up the headers for the request
-headers = {
-    'Authorization': 'Bearer ' + token.token,
-}
+    connection = sqlite3.connect(db_file)
+    with connection:
+        connection.execute("DROP TABLE IF EXISTS vm_skus")
+        connection.execute("CREATE TABLE vm_skus (" + ", ".join(f'"{column}" {column_types.get(column, "TEXT")}' for column in columns) + ")")
+        connection.executemany("INSERT INTO vm_skus VALUES (" + ", ".join("?" for column in columns) + ")",
+                               [tuple(row.get(column) for column in columns) for row in rows])
+        connection.execute("CREATE INDEX vm_skus_location ON vm_skus (location, vCPUs, MemoryGB)")
+        connection.execute("CREATE INDEX vm_skus_name ON vm_skus (name, location)")
+    connection.close()
 
-# Make the GET request
-response = requests.get(url, headers=headers)
+if __name__ == "__main__":
+    rows = asyncio.run(main())
 
-# Print the response
-if response.status_code == 200:
-    data = response.json()
-    df = pd.json_normalize(data['value'])
+    # Base columns first, then every capability column in the order it was first seen
+    columns = list(dict.fromkeys(['name', 'tier', 'size', 'family', 'location', 'zones', 'restrictions', 'locationRestrictions', 'vCPUs', 'MemoryGB'] +
+                                 [column for row in rows for column in row]))
 
-    # Filter the DataFrame to only include rows where resourceType is virtualMachines
-    df = df[df['resourceType'] == 'virtualMachines']
+    with open(output_csv_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
 
-    df.to_csv('Azure-VM-SKU-List.csv', index=False)
-else:
-    print(f"Request failed with status code {response.status_code}")
+    write_sku_index(rows, columns, output_db_file)
+    print(f"Wrote {len(rows)} SKU locations to {output_csv_file} and {output_db_file}")
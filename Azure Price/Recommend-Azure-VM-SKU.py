@@ -0,0 +1,144 @@
+# Azure Retail Prices overview
+# https://learn.microsoft.com/en-us/rest/api/cost-management/retail-prices/azure-retail-prices
+
+'''
+This python script will read an existing CSV file named "Azure-VM-Requirements.csv" with the columns:
+
+1. vCPUs
+2. MemoryGB
+3. armRegionName
+4. os
+
+Sample of these are:
+
+1. 4
+2. 16
+3. canadacentral
+4. Windows or Linux
+
+And recommend the cheapest VM SKUs that have at least the requested vCPUs and memory in the region, for each price type:
+payg (consumption), spot and reservation (one recommendation list per reservation term). The results are exported to a CSV
+named "Azure-VM-Recommendations.csv" with the hourly price and the monthly cost based on 730 hours.
+
+The SKU capabilities are read from the "Azure-VM-SKU-Index.db" created by Get-Azure-VM-SKUs.py and the prices are read from the
+price catalog snapshot (Azure-VM-Price-Snapshot-<currency>.db) created by Retrieve-Azure-VM-Cost-With-CSV-Reference.py with
+snapshot_mode enabled, or from its "Azure-VM-Price-Output.csv" output.
+
+Both datasets are loaded into an indexed in-memory SQLite database and every requirement is matched in one set-based query (a join
+ranked with a window function) instead of a nested loop. Identical requirement rows are only matched once.
+
+Reservation prices only cover the compute cost, so they are matched for both Windows and Linux requirements.
+
+'''
+
+#!/usr/bin/env python3
+import csv
+import os
+import re
+import sqlite3
+
+# Input and output files
+requirements_file = 'Azure-VM-Requirements.csv'
+sku_index_file = 'Azure-VM-SKU-Index.db'
+# Price catalog snapshot (.db) or the CSV output of Retrieve-Azure-VM-Cost-With-CSV-Reference.py (.csv)
+price_file = 'Azure-VM-Price-Snapshot-USD.db'
+output_file = 'Azure-VM-Recommendations.csv'
+
+# Number of SKUs recommended per requirement and price type
+top_n = 3
+
+# Function to classify a price item as payg, spot or reservation, returns None for price types that are not recommended
+def get_price_type(item_type, skuName):
+    if item_type == 'Reservation':
+        return 'reservation'
+    if item_type != 'Consumption' or skuName.endswith(' Low Priority'):
+        return None
+    if skuName.endswith(' Spot'):
+        return 'spot'
+    return 'payg'
+
+# Generator that yields (armRegionName, armSkuName, priceType, reservationTerm, os, hourly price) for every price that can be recommended
+def iter_prices(price_file):
+    if price_file.endswith('.db'):
+        connection = sqlite3.connect(price_file)
+        items = connection.execute("SELECT armRegionName, armSkuName, type, skuName, productName, retailPrice, reservationTerm FROM prices")
+    else:
+        f_in = open(price_file, 'r')
+        items = ((row['armRegionName'], row['armSkuName'], row['type'], row['skuName'], row['productName'], float(row['retailPrice']), row.get('reservationTerm'))
+                 for row in csv.DictReader(f_in))
+
+    for armRegionName, armSkuName, item_type, skuName, productName, retailPrice, reservationTerm in items:
+        priceType = get_price_type(item_type, skuName)
+        if priceType is None or not armSkuName:
+            continue
+        if priceType == 'reservation':
+            # The retailPrice of a reservation is the price of the whole term ("1 Year", "3 Years" or "5 Years")
+            years = int(re.match(r'\d+', reservationTerm).group())
+            yield armRegionName.lower(), armSkuName.lower(), priceType, reservationTerm, 'Any', retailPrice / (years * 8760)
+        else:
+            yield armRegionName.lower(), armSkuName.lower(), priceType, '', 'Windows' if 'Windows' in productName else 'Linux', retailPrice
+
+# Function to load the SKU capabilities and prices into an indexed in-memory database of candidate SKUs
+def load_candidates(sku_index_file, price_file):
+    connection = sqlite3.connect(':memory:')
+    connection.execute("ATTACH DATABASE ? AS sku_index", (sku_index_file,))
+    # A SKU is listed once per subscription that returned a different record for it, and a SKU restricted in only some zones of
+    # the location can still be deployed
+    connection.execute("""CREATE TABLE skus AS SELECT DISTINCT lower(name) AS sku, name, location, vCPUs, MemoryGB FROM sku_index.vm_skus
+                          WHERE locationRestrictions = '' AND vCPUs IS NOT NULL AND MemoryGB IS NOT NULL""")
+    connection.execute("DETACH DATABASE sku_index")
+    connection.execute("CREATE INDEX skus_lookup ON skus (sku, location)")
+
+    connection.execute("CREATE TABLE prices (location TEXT, sku TEXT, priceType TEXT, reservationTerm TEXT, os TEXT, hourly REAL)")
+    connection.executemany("INSERT INTO prices VALUES (?, ?, ?, ?, ?, ?)", iter_prices(price_file))
+
+    connection.execute("""CREATE TABLE candidates AS
+                          SELECT s.name, s.location, s.vCPUs, s.MemoryGB, p.priceType, p.reservationTerm, p.os, p.hourly
+                          FROM prices p JOIN skus s ON s.sku = p.sku AND s.location = p.location""")
+    connection.execute("CREATE INDEX candidates_lookup ON candidates (location, os, vCPUs, MemoryGB)")
+    connection.execute("DROP TABLE prices")
+    return connection
+
+# Function to return the top_n cheapest candidates for every requirement and price type, in one query for every requirement row
+def recommend(connection, requirements):
+    connection.execute("CREATE TEMP TABLE requirements (row_number INTEGER PRIMARY KEY, vCPUs REAL, MemoryGB REAL, location TEXT, os TEXT)")
+    connection.executemany("INSERT INTO requirements VALUES (?, ?, ?, ?, ?)",
+                           [(number, float(row['vCPUs']), float(row['MemoryGB']), row['armRegionName'].lower(), row['os'].capitalize())
+                            for number, row in enumerate(requirements, start=1)])
+    # Identical requirements are matched once and joined back to every row that asked for them
+    connection.execute("CREATE TEMP TABLE unique_requirements AS SELECT DISTINCT vCPUs, MemoryGB, location, os FROM requirements")
+
+    return connection.execute("""
+        WITH ranked AS (
+            SELECT u.vCPUs AS required_vCPUs, u.MemoryGB AS required_MemoryGB, u.location, u.os,
+                   c.priceType, c.reservationTerm, c.name, c.vCPUs, c.MemoryGB, c.hourly,
+                   ROW_NUMBER() OVER (PARTITION BY u.vCPUs, u.MemoryGB, u.location, u.os, c.priceType, c.reservationTerm
+                                      ORDER BY c.hourly, c.vCPUs, c.MemoryGB, c.name) AS rank
+            FROM unique_requirements u
+            JOIN candidates c ON c.location = u.location AND c.os IN (u.os, 'Any') AND c.vCPUs >= u.vCPUs AND c.MemoryGB >= u.MemoryGB
+        )
+        SELECT r.row_number, r.vCPUs, r.MemoryGB, r.location, r.os, k.priceType, k.reservationTerm, k.rank, k.name, k.vCPUs, k.MemoryGB, k.hourly, k.hourly * 730
+        FROM requirements r
+        JOIN ranked k ON k.required_vCPUs = r.vCPUs AND k.required_MemoryGB = r.MemoryGB AND k.location = r.location AND k.os = r.os
+        WHERE k.rank <= ?
+        ORDER BY r.row_number, k.priceType, k.reservationTerm, k.rank""", (top_n,))
+
+if __name__ == "__main__":
+    for required_file in [requirements_file, sku_index_file, price_file]:
+        if not os.path.exists(required_file):
+            raise SystemExit(f"The file '{required_file}' does not exist.")
+
+    with open(requirements_file, 'r') as f_in:
+        requirements = list(csv.DictReader(f_in))
+
+    connection = load_candidates(sku_index_file, price_file)
+    count = 0
+    with open(output_file, 'w', newline='') as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(['requirementRow', 'vCPUs', 'MemoryGB', 'armRegionName', 'os', 'priceType', 'reservationTerm', 'rank',
+                         'armSkuName', 'skuVCPUs', 'skuMemoryGB', 'Price (Hour)', 'Price (Month @ 730 hours)'])
+        for recommendation in recommend(connection, requirements):
+            writer.writerow(recommendation)
+            count += 1
+
+    print(f"Wrote {count} recommendations for {len(requirements)} requirements to {output_file}")
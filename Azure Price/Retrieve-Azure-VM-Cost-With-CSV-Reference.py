@@ -18,51 +18,731 @@ To retrieve the various prices for reservations, consumption, low priority, spot
 
 Then output it to the console in JSON and export to CSV named "Azure-VM-Price-Output.csv" adding a column for the monthly cost based on 730 hours.
 
+With batch_mode enabled (default) the input rows are grouped by currencyCode and armRegionName and each group is sent as one
+combined $filter (armSkuName eq 'A' or armSkuName eq 'B' ...), split into chunks that stay under the URL length limit. The
+returned items are then matched back to their input rows so the CSV is written in the same order as before.
+
+Queries are sent concurrently (up to max_concurrency at a time) over one shared requests session so the connections are kept
+alive and reused. Responses with HTTP 429 or 5xx are retried with backoff, honouring the Retry-After header.
+
+Responses are cached in a local SQLite file (cache_file) keyed by (currencyCode, $filter). Cached responses are reused for
+cache_ttl_hours, the least recently used entries are evicted above cache_max_entries, and cache_only answers from the cache
+without calling the API. An expired entry is kept and used when its refresh fails.
+
+Leave armSkuName empty to retrieve every price in a region. Pages are retrieved with a generator (iter_pages) and written to
+the CSV as they arrive, so memory stays at about one page no matter how many items the query returns.
+
+With snapshot_mode enabled the whole Virtual Machines price catalog for a currency is downloaded once into a local SQLite
+snapshot (snapshot_file) indexed on armRegionName, armSkuName, type and priceType, and every row is answered from the snapshot
+instead of the API. The snapshot is downloaded again when it is older than snapshot_max_age_hours.
+
+With columnar_mode enabled every page of items is converted straight into Arrow columns with a fixed schema (price_schema),
+the monthly, yearly and reservation-amortized costs are computed on the columns and the output is written to CSV or Parquet
+(output_format) by pyarrow. Fields that are not in price_schema are not written. This mode requires: pip install pyarrow
+
+With incremental_mode enabled the results are compared with the previous run (kept in state_file) and only the added, changed
+and retired prices are written to delta_file, with a changeType column. Prices are identified by meterId, skuId, type and
+reservationTerm, and a price is changed when its effectiveStartDate, retailPrice or unitPrice differ. A price is retired when
+it is no longer returned for an input row that was priced in the previous run. Incremental mode always downloads the current
+prices (the cache is not read), and an input row whose prices could not be retrieved completely neither retires prices nor
+updates the state, so it is compared again on the next run.
+
 '''
 
 # #!/usr/bin/env python3
 import requests
 import json
 import csv
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus, urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def fetch_data(currencyCode, armRegionName, armSkuName):
-    api_url = "https://prices.azure.com/api/retail/prices"
-    query = f"armRegionName eq '{armRegionName}' and armSkuName eq '{armSkuName}'"
+api_url = "https://prices.azure.com/api/retail/prices"
+
+# Group input rows by currencyCode and armRegionName and send one combined $filter per group instead of one query per row
+batch_mode = True
+# Maximum length of the URL encoded $filter query string for a combined query (keeps the request under the URL length limit)
+max_query_length = 2000
+# Maximum number of queries sent to the Retail Prices API at the same time
+max_concurrency = 8
+
+# Shared session so every request reuses a pooled keep-alive connection, throttled (429) and failed (5xx) requests are retried
+# (once the retries are used up the last response is returned, so the query is reported as an error and the run continues)
+session = requests.Session()
+retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'], raise_on_status=False)
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=retries))
+
+# Local SQLite cache of Retail Prices API responses keyed by (currencyCode, $filter), set cache_file = None to disable it
+cache_file = 'Azure-Retail-Prices-Cache.db'
+# Number of hours a cached response is used before it is retrieved again
+cache_ttl_hours = 24
+# Maximum number of cached queries, the least recently used queries are evicted first
+cache_max_entries = 10000
+# Offline mode: answer only from the cache (including expired entries) and never call the API
+cache_only = False
+
+# Answer every row from a local snapshot of the whole Virtual Machines price catalog instead of querying the API per row
+snapshot_mode = False
+# Snapshot file per currency, {currencyCode} is replaced with the currency of the row
+snapshot_file = 'Azure-VM-Price-Snapshot-{currencyCode}.db'
+# Number of hours before the snapshot is downloaded again
+snapshot_max_age_hours = 24
+# Number of snapshot rows returned per page when a whole region is read from the snapshot
+snapshot_page_size = 1000
+
+# Convert the items into Arrow columns, compute the cost columns on them and write the output with pyarrow (see the README for
+# the measured speed, decoding the JSON pages is not made faster and remains most of the run time)
+columnar_mode = False
+# Output format for columnar_mode: 'csv' or 'parquet'
+output_format = 'csv'
+# Number of prices written at a time
+columnar_chunk_size = 100000
+# Fields of a price item in the order the API returns them, with their Arrow type, used as the fixed schema of columnar_mode
+price_schema = [('currencyCode', 'string'), ('tierMinimumUnits', 'float64'), ('retailPrice', 'float64'), ('unitPrice', 'float64'),
+                ('armRegionName', 'string'), ('location', 'string'), ('effectiveStartDate', 'string'), ('meterId', 'string'),
+                ('meterName', 'string'), ('productId', 'string'), ('skuId', 'string'), ('productName', 'string'), ('skuName', 'string'),
+                ('serviceName', 'string'), ('serviceId', 'string'), ('serviceFamily', 'string'), ('unitOfMeasure', 'string'),
+                ('type', 'string'), ('isPrimaryMeterRegion', 'bool_'), ('armSkuName', 'string'), ('reservationTerm', 'string')]
+
+# Only write the prices that were added, changed or retired since the previous run (columnar_mode is ignored in this mode)
+incremental_mode = False
+# SQLite file holding the prices of the previous run
+state_file = 'Azure-VM-Price-State.db'
+# CSV file the added, changed and retired prices are written to
+delta_file = 'Azure-VM-Price-Delta.csv'
+
+# Persistent cache of Retail Prices API responses, stored page by page in a single SQLite file and keyed by (currencyCode, $filter)
+# Each download is written as a new generation of pages (fetched_at) so an expired copy stays readable until the refresh completes
+class PriceCache:
+    def __init__(self, path, ttl_hours, max_entries):
+        self.ttl = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            # Caches created before pages were stored per generation are discarded
+            columns = [column[1] for column in self.connection.execute("PRAGMA table_info(pages)")]
+            if columns and 'fetched_at' not in columns:
+                self.connection.execute("DROP TABLE pages")
+                self.connection.execute("DROP TABLE queries")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queries (currency TEXT, filter TEXT, fetched_at REAL, last_used REAL, PRIMARY KEY (currency, filter))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pages (currency TEXT, filter TEXT, fetched_at REAL, page INTEGER, body BLOB, PRIMARY KEY (currency, filter, fetched_at, page))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS queries_last_used ON queries (last_used)")
+
+    # Return the generation (fetched_at) of a cached query and whether it is still within the TTL, or (None, False) when it is not cached
+    def lookup(self, currency, query):
+        with self.lock:
+            row = self.connection.execute("SELECT fetched_at FROM queries WHERE currency = ? AND filter = ?", (currency, query)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, False
+            with self.connection:
+                self.connection.execute("UPDATE queries SET last_used = ? WHERE currency = ? AND filter = ?", (time.time(), currency, query))
+            fresh = time.time() - row[0] < self.ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale += 1
+            return row[0], fresh
+
+    # Yield the cached pages of a generation one at a time so only one page is held in memory
+    def read_pages(self, currency, query, fetched_at):
+        number = 0
+        while True:
+            with self.lock:
+                row = self.connection.execute("SELECT body FROM pages WHERE currency = ? AND filter = ? AND fetched_at = ? AND page = ?",
+                                              (currency, query, fetched_at, number)).fetchone()
+            if row is None:
+                return
+            yield json.loads(row[0])
+            number += 1
+
+    def write_page(self, currency, query, fetched_at, number, body):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO pages (currency, filter, fetched_at, page, body) VALUES (?, ?, ?, ?, ?)",
+                                    (currency, query, fetched_at, number, body))
+
+    # Make a fully downloaded generation the cached copy, then evict the least recently used queries above max_entries
+    def commit(self, currency, query, fetched_at):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO queries (currency, filter, fetched_at, last_used) VALUES (?, ?, ?, ?)", (currency, query, fetched_at, time.time()))
+            self.connection.execute("DELETE FROM pages WHERE currency = ? AND filter = ? AND fetched_at <> ?", (currency, query, fetched_at))
+            count = self.connection.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+            if count > self.max_entries:
+                evicted = self.connection.execute("SELECT currency, filter FROM queries ORDER BY last_used LIMIT ?", (count - self.max_entries,)).fetchall()
+                self.connection.executemany("DELETE FROM pages WHERE currency = ? AND filter = ?", evicted)
+                self.connection.executemany("DELETE FROM queries WHERE currency = ? AND filter = ?", evicted)
+
+    # Remove the pages of a download that did not complete
+    def discard(self, currency, query, fetched_at):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM pages WHERE currency = ? AND filter = ? AND fetched_at = ?", (currency, query, fetched_at))
+
+    def summary(self):
+        return f"Cache: {self.hits} hits, {self.misses} misses, {self.stale} expired"
+
+price_cache = PriceCache(cache_file, cache_ttl_hours, cache_max_entries) if cache_file else None
+
+# Raised by iter_pages when the pages of a $filter could not all be retrieved and no cached copy could be used instead
+class PriceQueryError(Exception):
+    pass
+
+# Generator that downloads the pages of a $filter one at a time by following NextPageLink, yielding the raw body and the decoded page
+# (pages of one query are fetched in order since each NextPageLink is only known from the previous page)
+# Returns True when every page was retrieved, False when a request failed (including connection errors)
+def download_pages(currencyCode, query):
+    url = api_url
     params = {
         'currencyCode': currencyCode,
         '$filter': query
     }
-    response = requests.get(api_url, params=params)
-
-    if response.status_code == 200:
+    while url:
         try:
-            json_data = json.loads(response.text)
-            nextPage = json_data['NextPageLink']
-    
-            while(nextPage):
-                response = requests.get(nextPage)
-                if response.status_code == 200:
-                    additional_data = json.loads(response.text)
-                    json_data['Items'].extend(additional_data['Items'])
-                    nextPage = additional_data['NextPageLink']
+            response = session.get(url, params=params)
+        except requests.RequestException as e:
+            print(f"Error: {e}")
+            return False
+        params = None  # NextPageLink already contains the query string
+        if response.status_code != 200:
+            print(f"Error: {response.status_code}")
+            return False
+        try:
+            # Decode the JSON straight from the response bytes, once per page
+            page = json.loads(response.content)
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON: {e}")
+            return False
+        yield response.content, page
+        url = page['NextPageLink']
+    return True
+
+# Generator that yields the pages of a $filter from the cache, downloading them when they are not cached or have expired
+# Raises PriceQueryError after the pages that were retrieved when the download did not complete
+def iter_pages(currencyCode, query):
+    cached = None
+    # Incremental mode compares the current prices with the previous run, so it never answers from the cache
+    if price_cache is not None and not incremental_mode:
+        cached, fresh = price_cache.lookup(currencyCode, query)
+        if fresh or cache_only:
+            if cached is None:
+                print(f"Not in cache (cache_only mode): {currencyCode} {query}")
+                return
+            yield from price_cache.read_pages(currencyCode, query, cached)
+            return
+
+    fetched_at = time.time()
+    downloaded = 0
+    complete = False
+    pages = download_pages(currencyCode, query)
+    try:
+        while True:
+            try:
+                body, page = next(pages)
+            except StopIteration as finished:
+                complete = finished.value
+                break
+            if price_cache is not None:
+                price_cache.write_page(currencyCode, query, fetched_at, downloaded, body)
+            downloaded += 1
+            yield page
+    finally:
+        if price_cache is not None:
+            if complete:
+                price_cache.commit(currencyCode, query, fetched_at)
+            else:
+                price_cache.discard(currencyCode, query, fetched_at)
+
+    # Conditional refresh: keep using the previously cached copy when the refresh fails before any page was returned
+    if not complete and downloaded == 0 and cached is not None:
+        print(f"Refresh failed, using expired cache entry: {currencyCode} {query}")
+        yield from price_cache.read_pages(currencyCode, query, cached)
+    elif not complete:
+        raise PriceQueryError(f"The prices could not be retrieved completely: {currencyCode} {query}")
+
+# Function to classify an item as Consumption, Spot, Low Priority, DevTestConsumption or Reservation
+def get_price_type(item):
+    if item['type'] == 'Consumption':
+        if item['skuName'].endswith(' Spot'):
+            return 'Spot'
+        if item['skuName'].endswith(' Low Priority'):
+            return 'Low Priority'
+    return item['type']
+
+# Local snapshot of the Virtual Machines price catalog for one currency, stored in a single SQLite file
+class PriceSnapshot:
+    def __init__(self, currencyCode):
+        self.currencyCode = currencyCode
+        self.path = snapshot_file.format(currencyCode=currencyCode)
+        if not os.path.exists(self.path) or time.time() - os.path.getmtime(self.path) > snapshot_max_age_hours * 3600:
+            self.download()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+
+    # Download the whole catalog into a new file and replace the previous snapshot only once every page was retrieved
+    def download(self):
+        print(f"Downloading the Virtual Machines price catalog for {self.currencyCode} into {self.path}")
+        temp_path = self.path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        connection = sqlite3.connect(temp_path)
+        connection.execute("""CREATE TABLE prices (armRegionName TEXT COLLATE NOCASE, armSkuName TEXT COLLATE NOCASE, type TEXT, priceType TEXT,
+                              productName TEXT, skuName TEXT, unitPrice REAL, retailPrice REAL, reservationTerm TEXT, item TEXT)""")
+        count = 0
+        pages = download_pages(self.currencyCode, "serviceName eq 'Virtual Machines'")
+        while True:
+            try:
+                body, page = next(pages)
+            except StopIteration as finished:
+                complete = finished.value
+                break
+            connection.executemany("INSERT INTO prices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   [(item['armRegionName'], item['armSkuName'], item['type'], get_price_type(item), item['productName'], item['skuName'],
+                                     item['unitPrice'], item['retailPrice'], item.get('reservationTerm'), json.dumps(item)) for item in page['Items']])
+            count += len(page['Items'])
+        if not complete:
+            connection.close()
+            os.remove(temp_path)
+            raise RuntimeError(f"Failed to download the price catalog for {self.currencyCode}")
+        connection.execute("CREATE INDEX prices_region_sku ON prices (armRegionName, armSkuName)")
+        connection.execute("CREATE INDEX prices_sku ON prices (armSkuName)")
+        connection.execute("CREATE INDEX prices_type ON prices (type, priceType)")
+        connection.commit()
+        connection.close()
+        os.replace(temp_path, self.path)
+        print(f"Downloaded {count} prices")
+
+    # Generator that yields the items of a region (and SKU when given) in pages, in the order the API returned them
+    def iter_pages(self, armRegionName, armSkuName):
+        if armSkuName:
+            query = "SELECT rowid, item FROM prices WHERE armRegionName = ? AND armSkuName = ? AND rowid > ? ORDER BY rowid LIMIT ?"
+            params = (armRegionName, armSkuName)
+        else:
+            query = "SELECT rowid, item FROM prices WHERE armRegionName = ? AND rowid > ? ORDER BY rowid LIMIT ?"
+            params = (armRegionName,)
+        last_rowid = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute(query, params + (last_rowid, snapshot_page_size)).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [json.loads(item) for rowid, item in rows]
+
+    def get_items(self, armRegionName, armSkuName):
+        items = []
+        for page in self.iter_pages(armRegionName, armSkuName):
+            items.extend(page)
+        return items
+
+snapshots = {}
+snapshots_lock = threading.Lock()
+
+# Function to return the snapshot of a currency, downloading it the first time it is needed
+def get_snapshot(currencyCode):
+    with snapshots_lock:
+        if currencyCode not in snapshots:
+            snapshots[currencyCode] = PriceSnapshot(currencyCode)
+        return snapshots[currencyCode]
+
+# Function to retrieve every item for a $filter, returns None when the items could not be retrieved completely
+def get_items(currencyCode, query):
+    items = []
+    try:
+        for page in iter_pages(currencyCode, query):
+            items.extend(page['Items'])
+    except PriceQueryError as e:
+        print(e)
+        return None
+    return items
+
+# Add 'Retail Price (Month @ 730 hours)' column (in columnar_mode it is computed on the DataFrame instead)
+def add_monthly_cost(items):
+    if items is None or columnar_mode and not incremental_mode:
+        return items
+    for item in items:
+        if item['type'] == 'Reservation':
+            item['Retail Price (Month @ 730 hours)'] = 'N/A'
+        else:
+            item['Retail Price (Month @ 730 hours)'] = item['retailPrice'] * 730
+    return items
+
+# Function to build the $filter for one input row, an empty armSkuName retrieves every price in the region
+def build_query(armRegionName, armSkuName):
+    if not armSkuName:
+        return f"armRegionName eq '{armRegionName}'"
+    return f"armRegionName eq '{armRegionName}' and armSkuName eq '{armSkuName}'"
+
+def fetch_data(currencyCode, armRegionName, armSkuName):
+    if snapshot_mode:
+        return add_monthly_cost(get_snapshot(currencyCode).get_items(armRegionName, armSkuName))
+    return add_monthly_cost(get_items(currencyCode, build_query(armRegionName, armSkuName)))
+
+# Generator that yields the items of one input row page by page, so a broad query never holds more than one page in memory
+# None is yielded last when the items could not be retrieved completely
+def iter_data(currencyCode, armRegionName, armSkuName):
+    if snapshot_mode:
+        for items in get_snapshot(currencyCode).iter_pages(armRegionName, armSkuName):
+            yield add_monthly_cost(items)
+        return
+    try:
+        for page in iter_pages(currencyCode, build_query(armRegionName, armSkuName)):
+            yield add_monthly_cost(page['Items'])
+    except PriceQueryError as e:
+        print(e)
+        yield None
+
+# Function to build the combined $filter for a list of SKUs in one region
+def build_batch_query(armRegionName, armSkuNames):
+    return f"armRegionName eq '{armRegionName}' and (" + " or ".join(f"armSkuName eq '{sku}'" for sku in armSkuNames) + ")"
+
+# Function to split the SKUs of one region into chunks whose combined $filter stays under max_query_length
+# URL encoding is done character by character, so the encoded length of the $filter is summed per SKU instead of encoding
+# the whole $filter again for every SKU that is added
+def split_batch_skus(armRegionName, armSkuNames):
+    chunks = []
+    chunk = []
+    base_length = len(urlencode({'$filter': build_batch_query(armRegionName, [])}))
+    length = base_length
+    for armSkuName in armSkuNames:
+        sku_length = len(quote_plus(f"armSkuName eq '{armSkuName}'")) + (len(quote_plus(" or ")) if chunk else 0)
+        if chunk and length + sku_length > max_query_length:
+            chunks.append(chunk)
+            chunk = []
+            length = base_length
+            sku_length = len(quote_plus(f"armSkuName eq '{armSkuName}'"))
+        chunk.append(armSkuName)
+        length += sku_length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+# Function to split the SKUs of one region into combined $filter expressions that stay under max_query_length
+def build_batch_queries(armRegionName, armSkuNames):
+    return [build_batch_query(armRegionName, chunk) for chunk in split_batch_skus(armRegionName, armSkuNames)]
+
+# Function to retrieve the prices of many SKUs in one region with combined queries and return them per SKU
+def fetch_data_batch(currencyCode, armRegionName, armSkuNames):
+    return fetch_data_batches([(currencyCode, armRegionName, armSkuNames)])[0]
+
+# Function to retrieve the prices for several (currencyCode, armRegionName, armSkuNames) groups, sending every combined query concurrently
+# The items of a SKU are None when its combined query could not be retrieved completely
+def fetch_data_batches(groups):
+    results = []
+    queries = []
+    for currencyCode, armRegionName, armSkuNames in groups:
+        # Remove duplicate SKUs while keeping the input order and spelling, the $filter comparison is not case sensitive
+        unique_skus = {}
+        for armSkuName in armSkuNames:
+            unique_skus.setdefault(armSkuName.lower(), armSkuName)
+        group_results = {key: [] for key in unique_skus}
+        results.append(group_results)
+        for chunk in split_batch_skus(armRegionName, list(unique_skus.values())):
+            queries.append((currencyCode, build_batch_query(armRegionName, chunk), group_results, chunk))
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        item_lists = executor.map(lambda query: get_items(query[0], query[1]), queries)
+        for (currencyCode, query, group_results, chunk), items in zip(queries, item_lists):
+            if items is None:
+                for armSkuName in chunk:
+                    group_results[armSkuName.lower()] = None
+                continue
+            for item in items:
+                # Demultiplex each returned item back to the SKU that requested it
+                key = item['armSkuName'].lower()
+                if group_results.get(key) is not None:
+                    group_results[key].append(item)
+
+    for group_results in results:
+        for items in group_results.values():
+            add_monthly_cost(items)
+
+    return [{armSkuName: group_results[armSkuName.lower()] for armSkuName in armSkuNames}
+            for (currencyCode, armRegionName, armSkuNames), group_results in zip(groups, results)]
+
+# Function to return the pages of items for each input row, in the same order as the input rows
+# Rows without an armSkuName (a whole region) are streamed page by page when the CSV writer reaches them
+def fetch_data_for_rows(rows):
+    if snapshot_mode:
+        # The snapshot answers each row locally, so there is nothing to batch or send concurrently
+        for row in rows:
+            yield iter_data(row['currencyCode'], row['armRegionName'], row['armSkuName'])
+        return
+
+    if not batch_mode:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            # Results are read back in input order even though the queries complete in any order
+            futures = [executor.submit(fetch_data, row['currencyCode'], row['armRegionName'], row['armSkuName']) if row['armSkuName'] else None for row in rows]
+            for row, future in zip(rows, futures):
+                if future is None:
+                    yield iter_data(row['currencyCode'], row['armRegionName'], row['armSkuName'])
                 else:
-                    print(f"Error: {response.status_code}")
-                    break
+                    yield [future.result()]
+        return
+
+    # Group the SKUs by currency and region
+    groups = {}
+    for row in rows:
+        if row['armSkuName']:
+            groups.setdefault((row['currencyCode'], row['armRegionName']), []).append(row['armSkuName'])
+
+    results = {}
+    groups = [(currencyCode, armRegionName, armSkuNames) for (currencyCode, armRegionName), armSkuNames in groups.items()]
+    for (currencyCode, armRegionName, armSkuNames), group_results in zip(groups, fetch_data_batches(groups)):
+        for armSkuName, items in group_results.items():
+            results[(currencyCode, armRegionName, armSkuName)] = items
+
+    for row in rows:
+        if row['armSkuName']:
+            yield [results[(row['currencyCode'], row['armRegionName'], row['armSkuName'])]]
+        else:
+            yield iter_data(row['currencyCode'], row['armRegionName'], row['armSkuName'])
+
+# Function to order the output columns like the first item with the cost columns right after unitPrice
+def get_fieldnames(data, exclude_columns, cost_columns, extra_columns=()):
+    all_keys = set().union(*[item.keys() for item in data], extra_columns, cost_columns)
+    all_keys = [key for key in all_keys if key not in exclude_columns]
+    first_item_keys = [key for key in data[0].keys() if key not in exclude_columns and key not in cost_columns]
+    position = first_item_keys.index('unitPrice') + 1
+    first_item_keys[position:position] = cost_columns
+    order = {key: index for index, key in enumerate(first_item_keys)}
+    return sorted(all_keys, key=lambda x: order.get(x, len(first_item_keys)))
+
+# Function to add the cost columns to an Arrow table of price items, computed on whole columns
+def add_cost_columns(table, output_format):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    is_reservation = pc.equal(table['type'], 'Reservation')
+    # reservationTerm is "1 Year", "3 Years" or "5 Years" and the retailPrice of a reservation is the price of the whole term
+    term_years = pc.cast(pc.struct_field(pc.extract_regex(table['reservationTerm'], r'(?P<years>\d+)'), 'years'), pa.float64())
+    retail_price = table['retailPrice']
+
+    monthly = pc.if_else(is_reservation, None, pc.multiply(retail_price, 730))
+    if output_format == 'csv':
+        monthly = pc.if_else(is_reservation, 'N/A', pc.cast(monthly, pa.string()))
+    table = table.append_column('Retail Price (Month @ 730 hours)', monthly)
+    table = table.append_column('Retail Price (Year @ 8760 hours)', pc.if_else(is_reservation, pc.divide(retail_price, term_years), pc.multiply(retail_price, 8760)))
+    table = table.append_column('Reservation Amortized (Month)', pc.if_else(is_reservation, pc.divide(retail_price, pc.multiply(term_years, 12)), None))
+    return table
+
+# Generator that yields the prices of every input row as Arrow tables, in the order of the input rows
+# The items of every page are converted into columns once, with the fixed price_schema. In batch_mode the prices of the combined
+# queries are matched to the rows that requested them with one join instead of a loop over the items
+def iter_price_tables(rows):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    item_type = pa.struct([(name, getattr(pa, type_name)()) for name, type_name in price_schema])
+
+    def to_table(items):
+        return pa.Table.from_struct_array(pa.array(items, type=item_type))
+
+    if snapshot_mode or not batch_mode:
+        for pages in fetch_data_for_rows(rows):
+            for data in pages:
+                if data:
+                    yield to_table(data)
+        return
+
+    # Group the SKUs by currency and region, without duplicates, and split them into combined queries
+    groups = {}
+    for row in rows:
+        if row['armSkuName']:
+            groups.setdefault((row['currencyCode'], row['armRegionName']), {}).setdefault(row['armSkuName'].lower(), row['armSkuName'])
+    queries = []
+    query_numbers = {}
+    for (currencyCode, armRegionName), unique_skus in groups.items():
+        for chunk in split_batch_skus(armRegionName, list(unique_skus.values())):
+            for armSkuName in chunk:
+                query_numbers[(currencyCode, armRegionName, armSkuName.lower())] = len(queries)
+            queries.append((currencyCode, build_batch_query(armRegionName, chunk)))
 
-            # Add 'Retail Price (Month @ 730 hours)' column
-            for item in json_data['Items']:
-                if item['type'] == 'Reservation':
-                    item['Retail Price (Month @ 730 hours)'] = 'N/A'
+    tables = []
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for number, items in enumerate(executor.map(lambda query: get_items(*query), queries)):
+            if items:
+                table = to_table(items)
+                tables.append(table.append_column('_query', pa.array([number] * table.num_rows, pa.int32())))
+
+    prices = None
+    if tables:
+        prices = pa.concat_tables(tables)
+        keys = pa.table({'_query': prices['_query'], '_sku': pc.utf8_lower(prices['armSkuName']),
+                         '_index': pa.array(range(prices.num_rows), pa.int64())})
+        requested = [(position, query_numbers[(row['currencyCode'], row['armRegionName'], row['armSkuName'].lower())], row['armSkuName'].lower())
+                     for position, row in enumerate(rows) if row['armSkuName']]
+        requested = pa.table({'_position': pa.array([request[0] for request in requested], pa.int64()),
+                              '_query': pa.array([request[1] for request in requested], pa.int32()),
+                              '_sku': pa.array([request[2] for request in requested], pa.string())})
+        # A row gets every price of its SKU, in the order of the rows and then in the order the API returned the prices. Only
+        # the key columns are joined, the prices are then taken in that order
+        matches = requested.join(keys, keys=['_query', '_sku'], join_type='inner').sort_by([('_position', 'ascending'), ('_index', 'ascending')])
+        positions = matches['_position']
+        prices = prices.select([name for name, type_name in price_schema]).take(matches['_index'])
+
+    # Consecutive SKU rows are one slice of the joined prices, whole-region rows are streamed page by page
+    position = 0
+    while position < len(rows):
+        row = rows[position]
+        if not row['armSkuName']:
+            for data in iter_data(row['currencyCode'], row['armRegionName'], row['armSkuName']):
+                if data:
+                    yield to_table(data)
+            position += 1
+            continue
+        end = position
+        while end < len(rows) and rows[end]['armSkuName']:
+            end += 1
+        if prices is not None:
+            start = pc.sum(pc.less(positions, position)).as_py() or 0
+            stop = pc.sum(pc.less(positions, end)).as_py() or 0
+            if stop > start:
+                yield prices.slice(start, stop - start)
+        position = end
+
+# Generator that groups the price tables of every row into tables of about columnar_chunk_size prices (without copying them)
+def iter_chunks(rows):
+    import pyarrow as pa
+    tables = []
+    size = 0
+    for table in iter_price_tables(rows):
+        tables.append(table)
+        size += table.num_rows
+        if size >= columnar_chunk_size:
+            yield pa.concat_tables(tables)
+            tables = []
+            size = 0
+    if tables:
+        yield pa.concat_tables(tables)
+
+# Function to write the prices of every row with pyarrow, one table per chunk
+def write_columnar(rows, output_file, exclude_columns):
+    # pip install pyarrow
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    cost_columns = ['Retail Price (Month @ 730 hours)', 'Retail Price (Year @ 8760 hours)', 'Reservation Amortized (Month)']
+    # The columns of price_schema in order, with the cost columns right after unitPrice
+    fieldnames = [name for name, type_name in price_schema if name not in exclude_columns]
+    position = fieldnames.index('unitPrice') + 1
+    fieldnames[position:position] = cost_columns
+    rows_written = 0
+    writer = None
+
+    if output_format == 'parquet':
+        output_file = os.path.splitext(output_file)[0] + '.parquet'
+
+    try:
+        for table in iter_chunks(rows):
+            table = add_cost_columns(table, output_format).select(fieldnames)
+            if writer is None:
+                if output_format == 'parquet':
+                    writer = pq.ParquetWriter(output_file, table.schema)
                 else:
-                    item['Retail Price (Month @ 730 hours)'] = item['retailPrice'] * 730
+                    writer = pa_csv.CSVWriter(output_file, table.schema, write_options=pa_csv.WriteOptions(quoting_style='needed'))
+            writer.write_table(table)
+            rows_written += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
 
-            return json_data['Items']
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON: {e}")
-    else:
-        print(f"Error: {response.status_code}")
+    print(f"Wrote {rows_written} prices to {output_file}")
+
+# Function to write only the prices that were added, changed or retired since the previous run
+def write_delta(rows, delta_file, exclude_columns):
+    connection = sqlite3.connect(state_file)
+    connection.execute("""CREATE TABLE IF NOT EXISTS prices (currencyCode TEXT, armRegionName TEXT, armSkuName TEXT, price_key TEXT,
+                          effectiveStartDate TEXT, retailPrice REAL, unitPrice REAL, row TEXT,
+                          PRIMARY KEY (currencyCode, armRegionName, armSkuName, price_key))""")
+    # Input rows and prices seen in this run, used to find the prices that were retired
+    connection.execute("CREATE TEMP TABLE scopes (currencyCode TEXT, armRegionName TEXT, armSkuName TEXT, PRIMARY KEY (currencyCode, armRegionName, armSkuName))")
+    connection.execute("CREATE TEMP TABLE seen (currencyCode TEXT, armRegionName TEXT, armSkuName TEXT, price_key TEXT, PRIMARY KEY (currencyCode, armRegionName, armSkuName, price_key))")
 
-    return []
+    key_columns = ['changeType', 'meterId', 'skuId']
+    previous_columns = ['previousEffectiveStartDate', 'previousRetailPrice']
+    counts = {'added': 0, 'changed': 0, 'retired': 0, 'unchanged': 0}
+    incomplete_rows = 0
+    writer = None
+    # Every change is made in one transaction, each input row in its own savepoint so an incomplete row can be undone
+    connection.execute("BEGIN")
+
+    with open(delta_file, 'w', newline='') as f_out:
+        for row, pages in zip(rows, fetch_data_for_rows(rows)):
+            scope = (row['currencyCode'], row['armRegionName'].lower(), row['armSkuName'].lower())
+            connection.execute("SAVEPOINT input_row")
+            complete = True
+            for data in pages:
+                if data is None:
+                    complete = False
+                    continue
+                for item in data:
+                    if writer is None:
+                        fieldnames = get_fieldnames([item], exclude_columns, ['Retail Price (Month @ 730 hours)'], ['reservationTerm'])
+                        writer = csv.DictWriter(f_out, fieldnames=key_columns + fieldnames + previous_columns, extrasaction='ignore')
+                        writer.writeheader()
+
+                    price_key = f"{item['meterId']}|{item['skuId']}|{item['type']}|{item.get('reservationTerm', '')}"
+                    connection.execute("INSERT OR IGNORE INTO seen VALUES (?, ?, ?, ?)", scope + (price_key,))
+                    previous = connection.execute("SELECT effectiveStartDate, retailPrice, unitPrice FROM prices WHERE currencyCode = ? AND armRegionName = ? AND armSkuName = ? AND price_key = ?",
+                                                  scope + (price_key,)).fetchone()
+                    current = (item['effectiveStartDate'], item['retailPrice'], item['unitPrice'])
+                    if previous is not None and tuple(previous) == current:
+                        counts['unchanged'] += 1
+                        continue
+
+                    output_row = {key: item[key] for key in item if key not in exclude_columns}
+                    output_row['meterId'] = item['meterId']
+                    output_row['skuId'] = item['skuId']
+                    stored_row = json.dumps(output_row)
+                    if previous is None:
+                        output_row['changeType'] = 'added'
+                    else:
+                        output_row['changeType'] = 'changed'
+                        output_row['previousEffectiveStartDate'] = previous[0]
+                        output_row['previousRetailPrice'] = previous[1]
+                    counts[output_row['changeType']] += 1
+                    writer.writerow(output_row)
+                    connection.execute("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?, ?, ?, ?)", scope + (price_key,) + current + (stored_row,))
+
+            if complete:
+                # Only input rows whose prices were all retrieved can retire prices
+                connection.execute("INSERT OR IGNORE INTO scopes VALUES (?, ?, ?)", scope)
+            else:
+                # The state of the row is left as it was, so the row is compared again on the next run (its changes written
+                # above are reported again then) and none of its prices are retired
+                connection.execute("ROLLBACK TO input_row")
+                incomplete_rows += 1
+                print(f"The prices of {row['currencyCode']} {row['armRegionName']} {row['armSkuName']} could not be retrieved completely, the row is compared again on the next run")
+            connection.execute("RELEASE input_row")
+
+        # Prices of an input row from the previous run that were not returned this time have been retired
+        retired = connection.execute("""SELECT p.currencyCode, p.armRegionName, p.armSkuName, p.price_key, p.row FROM prices p
+                                        JOIN scopes s ON p.currencyCode = s.currencyCode AND p.armRegionName = s.armRegionName AND p.armSkuName = s.armSkuName
+                                        WHERE NOT EXISTS (SELECT 1 FROM seen n WHERE n.currencyCode = p.currencyCode AND n.armRegionName = p.armRegionName
+                                                          AND n.armSkuName = p.armSkuName AND n.price_key = p.price_key)""").fetchall()
+        for currencyCode, armRegionName, armSkuName, price_key, previous_row in retired:
+            output_row = json.loads(previous_row)
+            output_row['changeType'] = 'retired'
+            if writer is None:
+                writer = csv.DictWriter(f_out, fieldnames=list(output_row.keys()), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(output_row)
+            counts['retired'] += 1
+        connection.executemany("DELETE FROM prices WHERE currencyCode = ? AND armRegionName = ? AND armSkuName = ? AND price_key = ?",
+                               [price[:4] for price in retired])
+
+    # The state is only saved once the whole run completed so a failed run is compared again the next time
+    connection.commit()
+    connection.close()
+    print(f"Delta: {counts['added']} added, {counts['changed']} changed, {counts['retired']} retired, {counts['unchanged']} unchanged, {incomplete_rows} incomplete input rows")
 
 if __name__ == "__main__":
     input_file = 'Azure-VM-Input.csv'  
@@ -70,21 +750,30 @@ if __name__ == "__main__":
 
     exclude_columns = ['tierMinimumUnits', 'meterName','serviceId','isPrimaryMeterRegion','productId','skuId','meterId']
 
-    with open(input_file, 'r') as f_in, open(output_file, 'w', newline='') as f_out:
-        reader = csv.DictReader(f_in)
-        writer = None
-
-        for row in reader:
-            data = fetch_data(row['currencyCode'], row['armRegionName'], row['armSkuName'])
-            if data:
-                if writer is None:
-                    all_keys = set().union(*[item.keys() for item in data])
-                    all_keys = [key for key in all_keys if key not in exclude_columns]
-                    first_item_keys = [key for key in data[0].keys() if key not in exclude_columns]
-                    first_item_keys.insert(first_item_keys.index('unitPrice') + 1, 'Retail Price (Month @ 730 hours)')
-                    fieldnames = sorted(all_keys, key=lambda x: first_item_keys.index(x) if x in first_item_keys else len(first_item_keys))
-                    writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-                    writer.writeheader()
-
-                items = [{key: item[key] for key in item if key not in exclude_columns} for item in data]
-                writer.writerows(items)
+    with open(input_file, 'r') as f_in:
+        rows = list(csv.DictReader(f_in))
+
+    if incremental_mode:
+        write_delta(rows, delta_file, exclude_columns)
+    elif columnar_mode:
+        write_columnar(rows, output_file, exclude_columns)
+    else:
+        with open(output_file, 'w', newline='') as f_out:
+            writer = None
+
+            for row, pages in zip(rows, fetch_data_for_rows(rows)):
+                for data in pages:
+                    if not data:
+                        continue
+                    if writer is None:
+                        # A whole-region row is streamed, so its first page may not contain a reservation item yet
+                        extra_columns = ['reservationTerm'] if not row['armSkuName'] else []
+                        fieldnames = get_fieldnames(data, exclude_columns, ['Retail Price (Month @ 730 hours)'], extra_columns)
+                        writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+                        writer.writeheader()
+
+                    items = [{key: item[key] for key in item if key not in exclude_columns} for item in data]
+                    writer.writerows(items)
+
+    if price_cache is not None:
+        print(price_cache.summary())
@@ -12,85 +12,295 @@ Sample of these are:
 
 1. CAD
 2. canadaeast
-3. Standard_D2_v4 or Standard_E2s_v5
+3. Standard_D2_v4 or Standard_E2s_v5 (several SKUs can be entered separated by commas, e.g. Standard_D2_v4,Standard_E2s_v5)
 
 To retrieve the various prices for reservations, consumption, low priority, spot.
 
 Then output it to the console in JSON and export to CSV named "Azure-Single-VM-Price.csv" adding a column for the monthly cost based on 730 hours.
 
+When several SKUs are entered they are retrieved concurrently (up to max_concurrency at a time) over one shared requests session
+that keeps its connections alive, and the items are returned in the order the SKUs were entered.
+
+Responses are cached in a local SQLite file (cache_file) keyed by (currencyCode, $filter). Cached responses are reused for
+cache_ttl_hours, the least recently used entries are evicted above cache_max_entries, and cache_only answers from the cache
+without calling the API. An expired entry is kept and used when its refresh fails.
+
+Leave the ARM SKU Name empty to retrieve every price in the region. The pages are written to the CSV as they arrive, and the
+combined JSON is only built when print_json is enabled, so set print_json = False for broad queries to keep memory at about
+one page no matter how many items the query returns.
+
 '''
 
 #!/usr/bin/env python3
 import requests
 import json
 import csv
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def main(currencyCode, armRegionName, armSkuName):
-    api_url = "https://prices.azure.com/api/retail/prices"
-    query = f"armRegionName eq '{armRegionName}' and armSkuName eq '{armSkuName}'"
+# Maximum number of SKUs retrieved from the Retail Prices API at the same time
+max_concurrency = 8
+
+# Print the combined JSON response to the console, this holds every item in memory (False streams the pages to the CSV only)
+print_json = True
+
+# Shared session so every request reuses a pooled keep-alive connection, throttled (429) and failed (5xx) requests are retried
+# (once the retries are used up the last response is returned, so the query is reported as an error and the run continues)
+session = requests.Session()
+retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'], raise_on_status=False)
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=retries))
+
+api_url = "https://prices.azure.com/api/retail/prices"
+
+# Local SQLite cache of Retail Prices API responses keyed by (currencyCode, $filter), set cache_file = None to disable it
+cache_file = 'Azure-Retail-Prices-Cache.db'
+# Number of hours a cached response is used before it is retrieved again
+cache_ttl_hours = 24
+# Maximum number of cached queries, the least recently used queries are evicted first
+cache_max_entries = 10000
+# Offline mode: answer only from the cache (including expired entries) and never call the API
+cache_only = False
+
+# Persistent cache of Retail Prices API responses, stored page by page in a single SQLite file and keyed by (currencyCode, $filter)
+# Each download is written as a new generation of pages (fetched_at) so an expired copy stays readable until the refresh completes
+class PriceCache:
+    def __init__(self, path, ttl_hours, max_entries):
+        self.ttl = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            # Caches created before pages were stored per generation are discarded
+            columns = [column[1] for column in self.connection.execute("PRAGMA table_info(pages)")]
+            if columns and 'fetched_at' not in columns:
+                self.connection.execute("DROP TABLE pages")
+                self.connection.execute("DROP TABLE queries")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queries (currency TEXT, filter TEXT, fetched_at REAL, last_used REAL, PRIMARY KEY (currency, filter))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pages (currency TEXT, filter TEXT, fetched_at REAL, page INTEGER, body BLOB, PRIMARY KEY (currency, filter, fetched_at, page))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS queries_last_used ON queries (last_used)")
+
+    # Return the generation (fetched_at) of a cached query and whether it is still within the TTL, or (None, False) when it is not cached
+    def lookup(self, currency, query):
+        with self.lock:
+            row = self.connection.execute("SELECT fetched_at FROM queries WHERE currency = ? AND filter = ?", (currency, query)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, False
+            with self.connection:
+                self.connection.execute("UPDATE queries SET last_used = ? WHERE currency = ? AND filter = ?", (time.time(), currency, query))
+            fresh = time.time() - row[0] < self.ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale += 1
+            return row[0], fresh
+
+    # Yield the cached pages of a generation one at a time so only one page is held in memory
+    def read_pages(self, currency, query, fetched_at):
+        number = 0
+        while True:
+            with self.lock:
+                row = self.connection.execute("SELECT body FROM pages WHERE currency = ? AND filter = ? AND fetched_at = ? AND page = ?",
+                                              (currency, query, fetched_at, number)).fetchone()
+            if row is None:
+                return
+            yield json.loads(row[0])
+            number += 1
+
+    def write_page(self, currency, query, fetched_at, number, body):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO pages (currency, filter, fetched_at, page, body) VALUES (?, ?, ?, ?, ?)",
+                                    (currency, query, fetched_at, number, body))
+
+    # Make a fully downloaded generation the cached copy, then evict the least recently used queries above max_entries
+    def commit(self, currency, query, fetched_at):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO queries (currency, filter, fetched_at, last_used) VALUES (?, ?, ?, ?)", (currency, query, fetched_at, time.time()))
+            self.connection.execute("DELETE FROM pages WHERE currency = ? AND filter = ? AND fetched_at <> ?", (currency, query, fetched_at))
+            count = self.connection.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+            if count > self.max_entries:
+                evicted = self.connection.execute("SELECT currency, filter FROM queries ORDER BY last_used LIMIT ?", (count - self.max_entries,)).fetchall()
+                self.connection.executemany("DELETE FROM pages WHERE currency = ? AND filter = ?", evicted)
+                self.connection.executemany("DELETE FROM queries WHERE currency = ? AND filter = ?", evicted)
+
+    # Remove the pages of a download that did not complete
+    def discard(self, currency, query, fetched_at):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM pages WHERE currency = ? AND filter = ? AND fetched_at = ?", (currency, query, fetched_at))
+
+    def summary(self):
+        return f"Cache: {self.hits} hits, {self.misses} misses, {self.stale} expired"
+
+price_cache = PriceCache(cache_file, cache_ttl_hours, cache_max_entries) if cache_file else None
+
+# Generator that downloads the pages of a $filter one at a time by following NextPageLink, yielding the raw body and the decoded page
+# (pages of one query are fetched in order since each NextPageLink is only known from the previous page)
+# Returns True when every page was retrieved, False when a request failed (including connection errors)
+def download_pages(currencyCode, query):
+    url = api_url
     params = {
         'currencyCode': currencyCode,
         '$filter': query
     }
-    response = requests.get(api_url, params=params)
-
-    if response.status_code == 200:
+    while url:
+        try:
+            response = session.get(url, params=params)
+        except requests.RequestException as e:
+            print(f"Error: {e}")
+            return False
+        params = None  # NextPageLink already contains the query string
+        if response.status_code != 200:
+            print(f"Error: {response.status_code}")
+            return False
         try:
-            json_data = json.loads(response.text)
-            nextPage = json_data['NextPageLink']
-    
-            while(nextPage):
-                response = requests.get(nextPage)
-                if response.status_code == 200:
-                    additional_data = json.loads(response.text)
-                    json_data['Items'].extend(additional_data['Items'])
-                    nextPage = additional_data['NextPageLink']
-                else:
-                    print(f"Error: {response.status_code}")
-                    break
-
-            # Add 'Retail Price (Month @ 730 hours)' column
-            for item in json_data['Items']:
-                if item['type'] == 'Reservation':
-                    item['Retail Price (Month @ 730 hours)'] = 'N/A'
-                else:
-                    item['Retail Price (Month @ 730 hours)'] = item['retailPrice'] * 730
-
-            return json_data
+            # Decode the JSON straight from the response bytes, once per page
+            page = json.loads(response.content)
         except json.JSONDecodeError as e:
             print(f"Error decoding JSON: {e}")
-    else:
-        print(f"Error: {response.status_code}")
+            return False
+        yield response.content, page
+        url = page['NextPageLink']
+    return True
+
+# Generator that yields the pages of a $filter from the cache, downloading them when they are not cached or have expired
+def iter_pages(currencyCode, query):
+    cached = None
+    if price_cache is not None:
+        cached, fresh = price_cache.lookup(currencyCode, query)
+        if fresh or cache_only:
+            if cached is None:
+                print(f"Not in cache (cache_only mode): {currencyCode} {query}")
+                return
+            yield from price_cache.read_pages(currencyCode, query, cached)
+            return
+
+    fetched_at = time.time()
+    downloaded = 0
+    complete = False
+    pages = download_pages(currencyCode, query)
+    try:
+        while True:
+            try:
+                body, page = next(pages)
+            except StopIteration as finished:
+                complete = finished.value
+                break
+            if price_cache is not None:
+                price_cache.write_page(currencyCode, query, fetched_at, downloaded, body)
+            downloaded += 1
+            yield page
+    finally:
+        if price_cache is not None:
+            if complete:
+                price_cache.commit(currencyCode, query, fetched_at)
+            else:
+                price_cache.discard(currencyCode, query, fetched_at)
+
+    # Conditional refresh: keep using the previously cached copy when the refresh fails before any page was returned
+    if not complete and downloaded == 0 and cached is not None:
+        print(f"Refresh failed, using expired cache entry: {currencyCode} {query}")
+        yield from price_cache.read_pages(currencyCode, query, cached)
+
+# Function to build the $filter for one SKU, an empty armSkuName retrieves every price in the region
+def build_query(armRegionName, armSkuName):
+    if not armSkuName:
+        return f"armRegionName eq '{armRegionName}'"
+    return f"armRegionName eq '{armRegionName}' and armSkuName eq '{armSkuName}'"
+
+# Generator that yields the pages of one SKU (or of the whole region) with the 'Retail Price (Month @ 730 hours)' column added
+def iter_price_pages(currencyCode, armRegionName, armSkuName):
+    for page in iter_pages(currencyCode, build_query(armRegionName, armSkuName)):
+        for item in page['Items']:
+            if item['type'] == 'Reservation':
+                item['Retail Price (Month @ 730 hours)'] = 'N/A'
+            else:
+                item['Retail Price (Month @ 730 hours)'] = item['retailPrice'] * 730
+        yield page
+
+# Function to retrieve the prices of one SKU with every page of items combined into the first response
+def get_price_data(currencyCode, armRegionName, armSkuName):
+    json_data = None
+    for page in iter_price_pages(currencyCode, armRegionName, armSkuName):
+        if json_data is None:
+            json_data = page
+        else:
+            json_data['Items'].extend(page['Items'])
+    return json_data
+
+# Generator that yields the pages of the SKUs entered, in the order the SKUs were entered. A single SKU or a whole region is
+# streamed page by page, several SKUs are retrieved concurrently (one combined page per SKU, each SKU only has a few prices)
+def iter_input_pages(currencyCode, armRegionName, armSkuName):
+    armSkuNames = [sku.strip() for sku in armSkuName.split(',') if sku.strip()]
+    if len(armSkuNames) <= 1:
+        yield from iter_price_pages(currencyCode, armRegionName, armSkuNames[0] if armSkuNames else '')
+        return
+
+    # executor.map returns the results in the order the SKUs were entered even though the queries complete in any order
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for data in executor.map(lambda sku: get_price_data(currencyCode, armRegionName, sku), armSkuNames):
+            if data:
+                yield data
+
+def main(currencyCode, armRegionName, armSkuName):
+    # Combine the items of every page into the first response
+    json_data = None
+    for page in iter_input_pages(currencyCode, armRegionName, armSkuName):
+        if json_data is None:
+            json_data = page
+        else:
+            json_data['Items'].extend(page['Items'])
+    if json_data is None:
+        return None
+    json_data['Count'] = len(json_data['Items'])
+    json_data['NextPageLink'] = None
+    return json_data
+
+# Function to write the items of every page to the CSV as they arrive, the columns are taken from the first item
+def write_csv(pages, output_file, exclude_columns):
+    with open(output_file, 'w', newline='') as file:
+        writer = None
+        for page in pages:
+            if not page['Items']:
+                continue
+            if writer is None:
+                # Get keys from the first item, reservationTerm is added since the first page may not contain a reservation
+                first_item_keys = [key for key in page['Items'][0].keys() if key not in exclude_columns and key != 'Retail Price (Month @ 730 hours)']
+                # Insert new column right after "unitPrice"
+                first_item_keys.insert(first_item_keys.index('unitPrice') + 1, 'Retail Price (Month @ 730 hours)')
+                if 'reservationTerm' not in first_item_keys:
+                    first_item_keys.append('reservationTerm')
+                writer = csv.DictWriter(file, fieldnames=first_item_keys, extrasaction='ignore')
+                writer.writeheader()
+            # Remove excluded columns from items and write them to CSV
+            writer.writerows({key: item[key] for key in item if key not in exclude_columns} for item in page['Items'])
 
 
 if __name__ == "__main__":
     currencyCode = input("Enter the Currency Code: ")
     armRegionName = input("Enter the ARM Region Name: ")
     armSkuName = input("Enter the ARM SKU Name: ")
-    data = main(currencyCode, armRegionName, armSkuName)
-    print(json.dumps(data, indent=4))
-
     # Define columns to exclude in the CSV export
     exclude_columns = ['tierMinimumUnits', 'meterName','serviceId','isPrimaryMeterRegion','productId','skuId','meterId']  # Replace with the columns you want to exclude
 
+    if print_json:
+        data = main(currencyCode, armRegionName, armSkuName)
+        print(json.dumps(data, indent=4))
+        pages = [data] if data else []
+    else:
+        pages = iter_input_pages(currencyCode, armRegionName, armSkuName)
+
     # Writing to CSV file
     try:
-        with open('Azure-Single-VM-Price.csv', 'w', newline='') as file:
-            if data['Items']:
-                # Get all possible keys
-                all_keys = set().union(*[item.keys() for item in data['Items']])
-                # Remove excluded columns
-                all_keys = [key for key in all_keys if key not in exclude_columns]
-                # Get keys from the first item
-                first_item_keys = [key for key in data['Items'][0].keys() if key not in exclude_columns]
-                # Insert new column right after "unitPrice"
-                first_item_keys.insert(first_item_keys.index('unitPrice') + 1, 'Retail Price (Month @ 730 hours)')
-                # Sort all_keys according to the order in first_item_keys
-                fieldnames = sorted(all_keys, key=lambda x: first_item_keys.index(x) if x in first_item_keys else len(first_item_keys))
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                writer.writeheader()
-                # Remove excluded columns from items and write them to CSV
-                items = [{key: item[key] for key in item if key not in exclude_columns} for item in data['Items']]
-                writer.writerows(items)
+        write_csv(pages, 'Azure-Single-VM-Price.csv', exclude_columns)
     except PermissionError:
         print("The file 'data.csv' is locked. Please close it and try again.")
+
+    if price_cache is not None:
+        print(price_cache.summary())
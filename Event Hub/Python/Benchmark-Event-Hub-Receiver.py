@@ -0,0 +1,340 @@
+# This Python script measures how many events per second Receive-from-Event-Hub-with-checkpoint-store-async.py can forward
+# to Log Analytics, without any Azure resources or network access so it can run offline (e.g. in a CI pipeline)
+#
+# In-process fakes of EventHubConsumerClient, BlobCheckpointStore, ClientSecretCredential and LogsIngestionClient are
+# registered in sys.modules before the receiver script is loaded, so the real receiver code (pipelines, batching, projector,
+# compression, checkpointing and spool) runs unchanged against them. The fake Event Hub produces synthetic APIM payloads shaped
+# like the sample in Send-JSON-to-Log-Analytics.py, and the fakes have configurable latency and error injection.
+#
+# The report shows events/s, the p50/p99 end-to-end latency (from the moment an event is handed to the receiver until the
+# request containing it was accepted by the fake Log Analytics), the peak memory of the process and the checkpoint writes
+# per event. The script exits with code 1 when an event was lost: neither uploaded nor left in the spool, but behind the final
+# checkpoint of its partition so it would not be read again.
+#
+# After the benchmark, a checkpoint safety run (SAFETY_RUN) sends events with injected upload errors and the spool disabled,
+# so failed events are neither delivered nor spooled, and checks that the checkpoints stayed before every one of them. Its
+# last batch of every partition is partial, so it is only sent by the flush when the partitions are closed on shutdown.
+#
+# The fake Log Analytics decompresses and parses every request to find the events in it, that cost is included in the results.
+
+import asyncio
+import contextlib
+import gzip
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+# orjson is used by the fake Log Analytics when it is installed, like in the receiver
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Define variables for the benchmark
+RECEIVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Receive-from-Event-Hub-with-checkpoint-store-async.py')
+PARTITIONS = 8 # Number of Event Hub partitions
+EVENTS_PER_PARTITION = 25000 # Number of events sent to every partition
+TARGET_RATE = None # Events per second sent across all partitions, None sends the events as fast as the receiver takes them
+RECEIVER_SETTINGS = {} # Variables of the receiver script to change for the benchmark, e.g. {"MAX_CONCURRENT_UPLOADS": 8}
+
+# Define variables for the fakes
+UPLOAD_LATENCY = 0.02 # Number of seconds every upload request to Log Analytics takes
+UPLOAD_ERROR_RATE = 0.0 # Fraction of the upload requests that fail with UPLOAD_ERROR_STATUS
+UPLOAD_ERROR_STATUS = 503 # HTTP status code of the injected upload errors (429 throttles the receiver)
+CHECKPOINT_LATENCY = 0.01 # Number of seconds every checkpoint write to the blob checkpoint store takes
+RANDOM_SEED = 0 # Seed of the error injection so every run fails the same requests
+
+# Variables changed for the checkpoint safety run after the benchmark (None skips it)
+SAFETY_RUN = {"EVENTS_PER_PARTITION": 5100, "TARGET_RATE": None, "UPLOAD_ERROR_RATE": 0.3, "UPLOAD_ERROR_STATUS": 503,
+              "RECEIVER_SETTINGS": {"SPOOL_MAX_BYTES": 0}}
+
+# Synthetic APIM payload shaped like the sample in Send-JSON-to-Log-Analytics.py, the RequestId identifies every event
+SAMPLE_EVENT = {
+    "EventTime": "11/24/2023 8:19:57 PM",
+    "ServiceName": "contoso-dev-openai-apim.azure-api.net",
+    "RequestId": "",
+    "RequestIp": "74.114.240.15",
+    "OperationName": "Creates a completion for the chat message",
+    "apikey": "6f82e8f56e604e6cae6e0999e6bdc013",
+    "requestbody": {
+        "messages": [
+            {
+                "role": "user",
+                "content": "How many sides does a octagon have?"
+            }
+        ],
+        "temperature": 0.7,
+        "top_p": 0.95,
+        "frequency_penalty": 0,
+        "presence_penalty": 0,
+        "max_tokens": 800,
+        "stop": None
+    },
+    "JWTToken": "bearer " + "eyJ0eXAiOiJKV1QiLCJhbGciOiJSUzI1NiJ9." + "x" * 1200 + ".signature",
+    "AppId": "12bccc26-b778-4a2d-ae7a-4f5732e7a79d",
+    "Oid": "ee116d59-d49b-4557-b2ab-c911f451d5c8",
+    "Name": "Contoso User"
+}
+
+# Results collected by the fakes
+class BenchmarkResults:
+    def __init__(self):
+        self.sent_at = {} # RequestId to the time the event was handed to the receiver
+        self.latencies = []
+        self.delivered = set() # RequestIds accepted by the fake Log Analytics
+        self.failed = set() # RequestIds of requests that failed with an injected error
+        self.upload_requests = 0
+        self.upload_errors = 0
+        self.checkpoint_writes = 0
+        self.uploads_after_close = 0 # Uploads sent after the receiver closed its LogsIngestionClient
+        self.checkpoints = {} # Partition ID to the sequence number of its last written checkpoint
+
+results = BenchmarkResults()
+
+# Fake azure.core.exceptions
+class AzureError(Exception):
+    pass
+
+class HttpResponseError(AzureError):
+    def __init__(self, message=None, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+# Fake azure.identity.aio
+class AccessToken:
+    def __init__(self, token, expires_on):
+        self.token = token
+        self.expires_on = expires_on
+
+class ClientSecretCredential:
+    def __init__(self, **kwargs):
+        pass
+
+    async def get_token(self, *scopes, **kwargs):
+        return AccessToken('benchmark-token', int(time.time()) + 3600)
+
+    async def close(self):
+        pass
+
+# Fake azure.monitor.ingestion.aio, accepts gzip-compressed JSON arrays and records which events were delivered
+class LogsIngestionClient:
+    def __init__(self, endpoint, credential, **kwargs):
+        self.credential = credential
+        self.random = random.Random(RANDOM_SEED)
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def upload(self, rule_id, stream_name, logs, content_encoding=None, **kwargs):
+        if self.closed:
+            results.uploads_after_close += 1
+            raise RuntimeError("Upload through a closed LogsIngestionClient")
+        await self.credential.get_token('https://monitor.azure.com//.default')
+        data = logs.read() if hasattr(logs, 'read') else logs
+        await asyncio.sleep(UPLOAD_LATENCY)
+        results.upload_requests += 1
+        request_ids = [log['RequestId'] for log in json_loads(gzip.decompress(data) if content_encoding == 'gzip' else data)]
+        if self.random.random() < UPLOAD_ERROR_RATE:
+            results.upload_errors += 1
+            results.failed.update(request_ids)
+            raise HttpResponseError(f"Injected error {UPLOAD_ERROR_STATUS}", status_code=UPLOAD_ERROR_STATUS)
+        now = time.perf_counter()
+        for request_id in request_ids:
+            if request_id not in results.delivered:
+                results.delivered.add(request_id)
+                results.latencies.append(now - results.sent_at[request_id])
+
+    async def close(self):
+        self.closed = True
+
+# Fake azure.eventhub.extensions.checkpointstoreblobaio
+class BlobCheckpointStore:
+    @classmethod
+    def from_connection_string(cls, *args, **kwargs):
+        return cls()
+
+# Fake azure.eventhub.aio
+class EventData:
+    def __init__(self, data, sequence_number):
+        self.data = data
+        self.sequence_number = sequence_number
+        self.offset = str(sequence_number)
+
+    @property
+    def body(self):
+        return iter([self.data])
+
+    def body_as_str(self, encoding='UTF-8'):
+        return self.data.decode(encoding)
+
+class PartitionContext:
+    def __init__(self, partition_id):
+        self.partition_id = partition_id
+        self.last_enqueued_event_properties = {'sequence_number': EVENTS_PER_PARTITION - 1}
+
+    async def update_checkpoint(self, event=None):
+        await asyncio.sleep(CHECKPOINT_LATENCY)
+        results.checkpoint_writes += 1
+        results.checkpoints[self.partition_id] = event.sequence_number
+
+class EventHubConsumerClient:
+    def __init__(self, **kwargs):
+        self.partition_contexts = []
+        self.on_partition_close = None
+        self.closed = False
+
+    @classmethod
+    def from_connection_string(cls, connection_string, **kwargs):
+        return cls(**kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Like the SDK, the partitions are closed (on_partition_close with reason SHUTDOWN) when the client is closed
+    async def close(self):
+        self.closed = True
+        partition_contexts, self.partition_contexts = self.partition_contexts, []
+        if self.on_partition_close:
+            for partition_context in partition_contexts:
+                await self.on_partition_close(partition_context, 'SHUTDOWN')
+
+    async def receive_batch(self, on_event_batch, max_batch_size=300, on_partition_initialize=None, on_partition_close=None, **kwargs):
+        self.on_partition_close = on_partition_close
+        await asyncio.gather(*[self.receive_partition(str(partition), on_event_batch, max_batch_size, on_partition_initialize)
+                               for partition in range(PARTITIONS)])
+
+    # Send every event of a partition in batches of max_batch_size, paced to TARGET_RATE when it is set
+    async def receive_partition(self, partition_id, on_event_batch, max_batch_size, on_partition_initialize):
+        partition_context = PartitionContext(partition_id)
+        self.partition_contexts.append(partition_context)
+        if on_partition_initialize:
+            await on_partition_initialize(partition_context)
+        prefix, suffix = json.dumps(SAMPLE_EVENT).encode().split(b'"RequestId": ""')
+        next_batch_at = time.perf_counter()
+        for first in range(0, EVENTS_PER_PARTITION, max_batch_size):
+            if self.closed:
+                break
+            if TARGET_RATE:
+                await asyncio.sleep(max(next_batch_at - time.perf_counter(), 0))
+                next_batch_at += max_batch_size * PARTITIONS / TARGET_RATE
+            events = []
+            now = time.perf_counter()
+            for sequence_number in range(first, min(first + max_batch_size, EVENTS_PER_PARTITION)):
+                request_id = f"{partition_id}-{sequence_number}"
+                results.sent_at[request_id] = now
+                events.append(EventData(prefix + f'"RequestId": "{request_id}"'.encode() + suffix, sequence_number))
+            await on_event_batch(partition_context, events)
+
+# Function/Method for registering a fake module (and its parent packages) in sys.modules
+def register_module(name, **attributes):
+    parts = name.split('.')
+    for index in range(1, len(parts)):
+        sys.modules.setdefault('.'.join(parts[:index]), types.ModuleType('.'.join(parts[:index])))
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+
+# Function/Method for loading the receiver script against the fakes
+def load_receiver(spool_dir):
+    register_module('azure.core.exceptions', AzureError=AzureError, HttpResponseError=HttpResponseError)
+    register_module('azure.identity.aio', ClientSecretCredential=ClientSecretCredential)
+    register_module('azure.monitor.ingestion.aio', LogsIngestionClient=LogsIngestionClient)
+    register_module('azure.eventhub.aio', EventHubConsumerClient=EventHubConsumerClient)
+    register_module('azure.eventhub.extensions.checkpointstoreblobaio', BlobCheckpointStore=BlobCheckpointStore)
+
+    spec = importlib.util.spec_from_file_location('receiver', RECEIVER_SCRIPT)
+    receiver = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(receiver)
+    receiver.SPOOL_DIR = spool_dir
+    for name, value in RECEIVER_SETTINGS.items():
+        setattr(receiver, name, value)
+    return receiver
+
+# Function/Method for the peak memory of this process in MB (None where the resource module is not available, e.g. Windows)
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1048576 if sys.platform == 'darwin' else peak / 1024
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+# Function/Method for reading the RequestIds of the requests left in the spool segments of the receiver
+def read_spooled_request_ids(receiver, spool_dir):
+    spool = receiver.LogSpool(spool_dir)
+    return {log['RequestId'] for name in spool.segments for data in spool.read_segment(name) for log in json_loads(gzip.decompress(data))}
+
+# Function/Method for running the receiver against the fakes until every event was sent, returns the elapsed seconds and the
+# RequestIds left in the spool
+def run_receiver():
+    with tempfile.TemporaryDirectory() as spool_dir:
+        receiver = load_receiver(spool_dir)
+        started = time.perf_counter()
+        # The receiver prints status lines for every batch, they are not part of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(receiver.main())
+        elapsed = time.perf_counter() - started
+        return elapsed, read_spooled_request_ids(receiver, os.path.join(spool_dir, 'worker-0'))
+
+# Function/Method for counting the events that were lost: not delivered, not in the spool and at or before the final checkpoint
+# of their partition (events after the checkpoint are read again when the receiver restarts)
+def count_lost_events(spooled):
+    lost = 0
+    reread = 0
+    for partition in range(PARTITIONS):
+        checkpoint = results.checkpoints.get(str(partition), -1)
+        for sequence_number in range(EVENTS_PER_PARTITION):
+            request_id = f"{partition}-{sequence_number}"
+            if request_id in results.delivered or request_id in spooled:
+                continue
+            if sequence_number <= checkpoint:
+                lost += 1
+            else:
+                reread += 1
+    return lost, reread
+
+if __name__ == "__main__":
+    total_events = PARTITIONS * EVENTS_PER_PARTITION
+    print(f"Forwarding {total_events} events from {PARTITIONS} partitions through {os.path.basename(RECEIVER_SCRIPT)}")
+    elapsed, spooled = run_receiver()
+
+    latencies = sorted(results.latencies)
+    lost, reread = count_lost_events(spooled)
+    memory = peak_memory_mb()
+    print(f"Events delivered: {len(results.delivered)} of {total_events} in {elapsed:.2f} seconds ({len(spooled - results.delivered)} left in the spool, {reread} read again after a restart)")
+    print(f"Throughput: {len(results.delivered) / elapsed:.0f} events/s")
+    print(f"End-to-end latency: p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"Peak memory: {memory:.0f} MB" if memory is not None else "Peak memory: not available on this platform")
+    print(f"Checkpoint writes: {results.checkpoint_writes} ({results.checkpoint_writes / total_events:.5f} per event)")
+    print(f"Upload requests: {results.upload_requests} ({results.upload_errors} failed with injected errors)")
+    uploads_after_close = results.uploads_after_close
+
+    if SAFETY_RUN:
+        globals().update(SAFETY_RUN)
+        results = BenchmarkResults()
+        _, spooled = run_receiver()
+        safety_lost, reread = count_lost_events(spooled)
+        print(f"Checkpoint safety run: {len(results.delivered)} of {PARTITIONS * EVENTS_PER_PARTITION} events delivered with {results.upload_errors} failed uploads and no spool, "
+              f"{reread} read again after a restart, {safety_lost} lost")
+        lost += safety_lost
+        uploads_after_close += results.uploads_after_close
+
+    if lost:
+        print(f"{lost} events were neither uploaded nor spooled, and are behind the checkpoint of their partition")
+    if uploads_after_close:
+        print(f"{uploads_after_close} uploads were sent after the LogsIngestionClient was closed, the partitions were closed too late")
+    if lost or uploads_after_close:
+        sys.exit(1)
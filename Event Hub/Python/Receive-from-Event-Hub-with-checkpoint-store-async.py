@@ -2,17 +2,45 @@
 # into a JSON array, send each processed event to a Data Collection Endpoint with Data Collection Rule, 
 # that will ingest the data into a Log Analytics workspace custom table
 #
+# Events are received in batches of up to MAX_BATCH_SIZE events (or whatever arrived within MAX_WAIT_TIME seconds),
+# and each batch is sent to Log Analytics in one upload. Each partition is processed by its own pipeline of stages (parse,
+# batch, upload, checkpoint) connected by bounded queues, with up to MAX_CONCURRENT_UPLOADS uploads of the partition in flight.
+# The checkpoint is written every CHECKPOINT_EVERY_EVENTS events or CHECKPOINT_EVERY_SECONDS seconds rather than per batch,
+# and points to the last event that was delivered in offset order.
+# Events are mapped to the columns of the Data Collection Rule stream declaration (DCR_FILE) by a projector compiled once at startup.
+# Set WORKER_PROCESSES above 1 to run a supervisor that starts that many receiver processes, the partitions are balanced across
+# them through the checkpoint store and their throughput and lag are printed together.
+# Logs are packed into gzip-compressed requests of up to UPLOAD_MAX_BYTES of JSON before they are uploaded, requests that
+# fail are written to a local spool (SPOOL_DIR) and replayed in the background so the events behind them can be checkpointed
+#
 # Please see the following blog post for more information: https://terenceluk.blogspot.com/2023/11/python-script-that-will-asynchronously.html
 
 import asyncio
+import functools
+import gzip
+import io
 import json
+import multiprocessing
+import operator
+import os
+import queue
+import random
+import time
 from datetime import datetime
 from azure.eventhub.aio import EventHubConsumerClient
 from azure.eventhub.extensions.checkpointstoreblobaio import BlobCheckpointStore
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import AzureError
 from azure.identity.aio import ClientSecretCredential
 from azure.monitor.ingestion.aio import LogsIngestionClient
 
+# orjson decodes and encodes JSON faster than the json module when it is installed (pip install orjson)
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
 # Define variables for Event Hub
 EVENT_HUB_CONNECTION_STR = "Endpoint=sb://contosoapimevhns.servicebus.windows.net/;SharedAccessKeyName=PreviewDataPolicy;SharedAccessKey=#######################;EntityPath=contosoapimevh"
 EVENTHUB_NAME = 'contosoapimevh' # Note that I experienced issues having "dashes" or "hyphens" for the event hub when creating an Eventhub trigger for function app
@@ -33,90 +61,602 @@ LOGS_DCR_RULE_ID="dcr-##################################" # Data Collection Rule
 CONSUMER_GROUP = "$Default" # Consumer group for Event Hub
 LOGS_DCR_STREAM_NAME="Custom-APIMOpenAILogs_CL" # Data Collection Rule "streamDeclarations"
 
+# Define variables for converting events into logs for the custom table
+DCR_FILE = None # Data Collection Rule exported as JSON (or only its streamDeclarations), the columns of LOGS_DCR_STREAM_NAME are read from it
+DEFAULT_COLUMNS = ["EventTime", "ServiceName", "RequestId", "RequestIp", "OperationName", "apikey", "requestbody", "JWTToken", "AppId", "Oid", "Name"] # Columns used when DCR_FILE is None
+FIELD_RENAMES = {} # Column name to event field name for columns named differently in the event, e.g. {"JWTToken": "jwt"}
+OPTIONAL_COLUMNS = [] # Columns that can be missing from the event, every other column is required
 
-# Function/Method for ingesting log into Log Analytics
-async def send_logs(body):
-    print("Start send_logs def function/method - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-    # Configure authentication to App Registration credential object
-    print("Create client secret object - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-    credential = ClientSecretCredential(tenant_id=AZURE_TENANT_ID,client_id=AZURE_CLIENT_ID,client_secret=AZURE_CLIENT_SECRET)
-    print("Done creating client secret object - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-    # Configure log ingestion object
-    print("Create log client object - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-    log_client = LogsIngestionClient(endpoint=DATA_COLLECTION_ENDPOINT, credential=credential, logging_enable=True)
-    print("Done creating client object - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-    try:
-        print("Start upload of JSON to Log Analytics - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-        await log_client.upload(rule_id=LOGS_DCR_RULE_ID, stream_name=LOGS_DCR_STREAM_NAME, logs=body)
+
+# Define variables for batch receiving and the processing pipeline of each partition
+MAX_BATCH_SIZE = 500 # Maximum number of events received in one batch and uploaded to Log Analytics in one upload
+MAX_WAIT_TIME = 5 # Maximum number of seconds to wait for a batch to fill up before uploading the events received so far
+PIPELINE_QUEUE_SIZE = 4 # Maximum number of batches waiting between two stages of a partition pipeline
+MAX_CONCURRENT_UPLOADS = 4 # Maximum number of batches of a partition being uploaded at the same time
+THROTTLE_BACKOFF = 10 # Number of seconds new uploads are held back after Log Analytics throttled an upload (HTTP 429)
+
+# Define variables for scaling out over several processes and reporting metrics
+WORKER_PROCESSES = 1 # Number of receiver processes started by the supervisor (1 runs the receiver in this process without a supervisor)
+METRICS_INTERVAL = 30 # Number of seconds between throughput and lag reports
+
+# Define variables for the checkpoint policy, the checkpoint is written when either limit is reached (set a limit to None to disable it)
+# and always when the receiver shuts down or the partition is taken over by another receiver
+CHECKPOINT_EVERY_EVENTS = 5000 # Write the checkpoint once this many events were delivered since the last checkpoint
+CHECKPOINT_EVERY_SECONDS = 30 # Write the checkpoint once the oldest delivered event that is not checkpointed is this many seconds old
+
+
+# Define variables for the Log Analytics ingestion client
+UPLOAD_MAX_BYTES = 1000000 # Maximum size of the uncompressed JSON sent in one request, the Logs Ingestion API accepts up to 1 MB per request
+GZIP_LEVEL = 6 # gzip compression level of the request bodies (1 is fastest, 9 is smallest)
+TOKEN_REFRESH_MARGIN = 240 # Number of seconds before the access token expires that a new token is requested in the background
+
+# Define variables for the local spool of failed uploads, requests that fail with a retryable error are written to the spool
+# and replayed in the background, so their events can still be checkpointed
+SPOOL_DIR = 'Log-Analytics-Spool' # Directory of the spool segment files (one sub directory per worker process)
+SPOOL_SEGMENT_BYTES = 16 * 1048576 # Size at which a segment file is closed and a new one is started
+SPOOL_MAX_BYTES = 1024 * 1048576 # Maximum disk space used by the spool, when it is full the checkpoint is held before the failed logs until a restart
+SPOOL_FSYNC_DELAY = 0.05 # Number of seconds failed uploads wait to be written to disk together with one fsync
+SPOOL_REPLAY_RATE = 2 # Maximum number of spooled requests replayed per second, so the replay does not starve live uploads
+SPOOL_RETRY_BASE_DELAY = 1 # First delay in seconds before a failed replay is retried, doubled on every failure (with random jitter)
+SPOOL_RETRY_MAX_DELAY = 300 # Maximum delay in seconds between two replay attempts
+SPOOL_POLL_INTERVAL = 5 # Number of seconds between checks for spooled requests when the spool is empty
+
+
+# Generator that packs logs into gzip-compressed JSON arrays of up to UPLOAD_MAX_BYTES uncompressed bytes,
+# yields (compressed request body, logs in the request, uncompressed size). A log larger than the limit is sent on its own.
+def pack_logs(logs):
+    chunk = []
+    encoded = []
+    size = 2
+    for log in logs:
+        data = json_dumps(log)
+        if chunk and size + len(data) + 1 > UPLOAD_MAX_BYTES:
+            yield gzip.compress(b'[' + b','.join(encoded) + b']', GZIP_LEVEL), chunk, size
+            chunk = []
+            encoded = []
+            size = 2
+        chunk.append(log)
+        encoded.append(data)
+        size += len(data) + (1 if len(chunk) > 1 else 0)
+    if chunk:
+        yield gzip.compress(b'[' + b','.join(encoded) + b']', GZIP_LEVEL), chunk, size
+
+# Function/Method for deciding if a failed upload can succeed when it is sent again, requests that Log Analytics rejected as invalid
+# (400 Bad Request, 413 Payload Too Large) will never succeed
+def is_retryable(error):
+    return getattr(error, 'status_code', None) not in (400, 413)
+
+# Write-ahead spool of compressed requests that failed to upload, kept in append-only segment files in the spool directory.
+# Each record is the 4-byte length of the request body followed by the body. Requests that fail at about the same time are
+# written to disk with one fsync, the segment is closed at SPOOL_SEGMENT_BYTES and closed segments are replayed oldest first
+# and deleted once every request in them was uploaded. A crash during a replay sends the requests of that segment again.
+class LogSpool:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Segments left by a previous run are replayed first
+        self.segments = sorted(name for name in os.listdir(directory) if name.endswith('.spool'))
+        self.size = sum(os.path.getsize(os.path.join(directory, name)) for name in self.segments)
+        self.next_segment = int(self.segments[-1].split('.')[0]) + 1 if self.segments else 0
+        self.file = None
+        self.file_name = None
+        self.file_size = 0
+        self.sync = None # Pending fsync shared by every append waiting for it
+        self.lock = asyncio.Lock()
+
+    # Write a request body to the spool and wait until it is on disk, returns False when the spool is full
+    async def append(self, data):
+        record_size = len(data) + 4
+        if self.size + record_size > SPOOL_MAX_BYTES:
+            return False
+        if self.file is None:
+            self.file_name = f"{self.next_segment:012d}.spool"
+            self.next_segment += 1
+            self.file = open(os.path.join(self.directory, self.file_name), 'ab')
+            self.file_size = 0
+        self.file.write(len(data).to_bytes(4, 'big') + data)
+        self.size += record_size
+        self.file_size += record_size
+        if self.sync is None:
+            self.sync = asyncio.create_task(self.flush())
+        await asyncio.shield(self.sync)
+        return True
+
+    async def flush(self):
+        # Wait for other failed uploads to join this fsync
+        await asyncio.sleep(SPOOL_FSYNC_DELAY)
+        async with self.lock:
+            self.sync = None
+            if self.file is None:
+                return
+            self.file.flush()
+            await asyncio.to_thread(os.fsync, self.file.fileno())
+            if self.file_size >= SPOOL_SEGMENT_BYTES:
+                self.seal()
+
+    # Close the active segment so it can be replayed, including what was appended while the last fsync was running
+    def seal(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.segments.append(self.file_name)
+        self.file = None
+
+    # Wait for the oldest closed segment, the active segment is closed when nothing else is left to replay
+    async def next_replay_segment(self):
+        while True:
+            if self.segments:
+                return self.segments[0]
+            async with self.lock:
+                if self.file is not None and self.sync is None:
+                    self.seal()
+                    continue
+            await asyncio.sleep(SPOOL_POLL_INTERVAL)
+
+    # Read the request bodies of a segment, a record that was only partially written before a crash is ignored
+    def read_segment(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as file:
+            data = file.read()
+        records = []
+        position = 0
+        while position + 4 <= len(data):
+            length = int.from_bytes(data[position:position + 4], 'big')
+            if position + 4 + length > len(data):
+                break
+            records.append(data[position + 4:position + 4 + length])
+            position += 4 + length
+        return records
+
+    def remove_segment(self, name):
+        path = os.path.join(self.directory, name)
+        self.size -= os.path.getsize(path)
+        os.remove(path)
+        self.segments.remove(name)
+
+    async def close(self):
+        async with self.lock:
+            if self.file is not None:
+                self.seal()
+
+# One credential and LogsIngestionClient shared by every partition for the lifetime of the receiver, so each upload reuses
+# the warm connection pool and the access token instead of signing in and opening a new connection for every batch.
+# The client asks for the token before every request, it is answered from the token kept here and a background task
+# requests a new token TOKEN_REFRESH_MARGIN seconds before it expires, so no upload waits for Azure AD.
+class LogsIngestionSink:
+    def __init__(self, spool_dir):
+        self.credential = ClientSecretCredential(tenant_id=AZURE_TENANT_ID,client_id=AZURE_CLIENT_ID,client_secret=AZURE_CLIENT_SECRET)
+        self.log_client = LogsIngestionClient(endpoint=DATA_COLLECTION_ENDPOINT, credential=self, logging_enable=True)
+        self.scopes = None
+        self.token = None
+        self.refresh_task = None
+        self.lock = asyncio.Lock()
+        self.throttled_until = 0
+        self.spool = LogSpool(spool_dir)
+        self.replay_task = None
+
+    async def __aenter__(self):
+        print("Create log client object - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+        await self.log_client.__aenter__()
+        self.replay_task = asyncio.create_task(self.replay_spool())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Token credential used by the LogsIngestionClient
+    async def get_token(self, *scopes, **kwargs):
+        if self.token is None:
+            async with self.lock:
+                if self.token is None:
+                    self.scopes = scopes
+                    self.token = await self.credential.get_token(*scopes)
+                    self.refresh_task = asyncio.create_task(self.refresh_token())
+        return self.token
+
+    # Background task that replaces the access token before it expires, retrying every 30 seconds if Azure AD can not be reached
+    async def refresh_token(self):
+        while True:
+            await asyncio.sleep(max(self.token.expires_on - TOKEN_REFRESH_MARGIN - time.time(), 0))
+            try:
+                self.token = await self.credential.get_token(*self.scopes)
+                print("Refreshed Log Analytics access token - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+            except Exception as e:
+                print(f"Token refresh failed, retrying in 30 seconds: {e}")
+                await asyncio.sleep(30)
+
+    async def upload(self, data):
+        await self.log_client.upload(rule_id=LOGS_DCR_RULE_ID, stream_name=LOGS_DCR_STREAM_NAME, logs=io.BytesIO(data), content_encoding="gzip")
+
+    # Upload logs to Log Analytics in gzip-compressed requests of up to UPLOAD_MAX_BYTES. A request that fails with a retryable
+    # error is written to the spool and counts as delivered, returns the logs that failed and could not be spooled.
+    async def send(self, body):
+        failed_logs = []
+        print(f"Start upload of {len(body)} logs to Log Analytics - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+        for data, logs, size in pack_logs(body):
+            try:
+                await self.upload(data)
+                metrics.add_request(len(logs), size, len(data))
+            except AzureError as e:
+                print(f"Upload failed: {e}")
+                self.check_throttled(e)
+                if not is_retryable(e):
+                    print(f"Dropping {len(logs)} logs rejected by Log Analytics")
+                elif await self.spool.append(data):
+                    metrics.spooled += len(logs)
+                else:
+                    print(f"Spool is full, {len(logs)} logs were not delivered, the checkpoint of their partition is held before them")
+                    failed_logs.extend(logs)
         print("Done uploading JSON to Log Analytics - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-    except HttpResponseError as e:
-        print(f"Upload failed: {e}")
-    # Close credential and log_client session (this will hang if we forget to do so)
-    await credential.close()
-    await log_client.close()
-
-# Function/Method for processing each incoming event
-async def on_event(partition_context, event):
-    '''
-    # Print the event data.
-    print(
-        'Received the event: "{}" from the partition with ID: "{}"'.format(
-            event.body_as_str(encoding="UTF-8"), partition_context.partition_id
-        )
-    )
-    '''
-
-    # Load Event Hub data into string
-    data = json.loads(event.body_as_str())
-    
-    # Retrieve and store each column value in a variable to construct JSON for Log Analytics custom table ingestion
-    EventTime = data['EventTime']
-    ServiceName = data['ServiceName']
-    RequestId = data['RequestId']
-    RequestIp = data['RequestIp']
-    OperationName = data['OperationName']
-    apikey = data['apikey']
-    requestbody = data['requestbody']
-    JWTToken = data['JWTToken']
-    AppId = data['AppId']
-    Oid = data['Oid']
-    Name = data['Name']
-
-    # Create JSON to send into Azure Log Analytics custom table - Replaces the ' with " and adds array bracket []
-    event_data_for_log_analytics = [{
-        "EventTime": EventTime,
-        "ServiceName": ServiceName,
-        "RequestId": RequestId,
-        "RequestIp": RequestIp,
-        "OperationName": OperationName,
-        "apikey": apikey,
-        "requestbody": requestbody,
-        "JWTToken": JWTToken,
-        "AppId": AppId,
-        "Oid": Oid,
-        "Name": Name
-    }]
-    
-    # Print JSON created for Log Analytics data ingestion
-    print("----------------------------------------")
-    print("The JSON created for Log Analytics ingestion is: ")
-    print(event_data_for_log_analytics)
-    print("----------------------------------------")
-    
-    try: 
-        # Call send_logs method/function to send the constructed JSON to Log Analytics
-        print("Start sending logs to log analytics - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-        await send_logs(event_data_for_log_analytics)
-        print("Done sending logs to log analytics - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-
-        # Update the checkpoint so that the program doesn't read the events that it has already read when you run it next time.
-        print("Start updating checkpoint - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-        await partition_context.update_checkpoint(event)
-        print("Done Start updating checkpoint - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-    except Exception as e:
-        print(f"Error processing event: {e}")
-
-async def main():
+        return failed_logs
+
+    # Background task that uploads the spooled requests oldest first, at most SPOOL_REPLAY_RATE requests per second and never
+    # while Log Analytics is throttling. A failed replay is retried with exponential backoff and random jitter.
+    async def replay_spool(self):
+        attempts = 0
+        while True:
+            name = await self.spool.next_replay_segment()
+            records = await asyncio.to_thread(self.spool.read_segment, name)
+            print(f"Replaying {len(records)} spooled requests from {name} - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+            for data in records:
+                while True:
+                    await self.wait_if_throttled()
+                    try:
+                        await self.upload(data)
+                        metrics.replayed += 1
+                        attempts = 0
+                        break
+                    except AzureError as e:
+                        self.check_throttled(e)
+                        if not is_retryable(e):
+                            print(f"Dropping a spooled request rejected by Log Analytics: {e}")
+                            break
+                        delay = random.uniform(0, min(SPOOL_RETRY_MAX_DELAY, SPOOL_RETRY_BASE_DELAY * 2 ** attempts))
+                        attempts += 1
+                        print(f"Replay failed, retrying in {delay:.1f} seconds: {e}")
+                        await asyncio.sleep(delay)
+                await asyncio.sleep(1 / SPOOL_REPLAY_RATE)
+            self.spool.remove_segment(name)
+
+    # Hold back new uploads for THROTTLE_BACKOFF seconds when Log Analytics throttled an upload
+    def check_throttled(self, error):
+        if getattr(error, 'status_code', None) == 429:
+            self.throttled_until = time.monotonic() + THROTTLE_BACKOFF
+
+    async def wait_if_throttled(self):
+        delay = self.throttled_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Close the token refresh task, log_client and credential sessions (this will hang if we forget to do so)
+    async def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        if self.replay_task is not None:
+            self.replay_task.cancel()
+        await self.spool.close()
+        await self.log_client.close()
+        await self.credential.close()
+
+# Function/Method for loading the columns of the Log Analytics custom table from the Data Collection Rule stream declaration
+def load_stream_columns():
+    if not DCR_FILE:
+        return DEFAULT_COLUMNS
+    with open(DCR_FILE, 'r') as file:
+        dcr = json.load(file)
+    # Accept the full Data Collection Rule (as exported from the portal or the REST API) or only its streamDeclarations
+    stream_declarations = dcr.get('properties', dcr).get('streamDeclarations', dcr)
+    return [column['name'] for column in stream_declarations[LOGS_DCR_STREAM_NAME]['columns']]
+
+# Function/Method for compiling the field mapping once into a projector that converts a decoded event into the JSON for the
+# Log Analytics custom table. A missing required field raises KeyError, a missing optional field is left out of the log.
+# The event fields of the required columns are kept in project.required_fields for the check of the first event.
+def compile_projector(columns):
+    required = [column for column in columns if column not in OPTIONAL_COLUMNS]
+    optional = [(column, FIELD_RENAMES.get(column, column)) for column in columns if column in OPTIONAL_COLUMNS]
+    fields = [FIELD_RENAMES.get(column, column) for column in required]
+    # itemgetter returns a tuple of the values when it gets more than one field
+    get_required = operator.itemgetter(*fields) if len(fields) > 1 else lambda data: tuple(data[field] for field in fields)
+
+    def project(data):
+        log = dict(zip(required, get_required(data)))
+        for column, field in optional:
+            if field in data:
+                log[column] = data[field]
+        return log
+    project.required_fields = fields
+    return project
+
+# Function/Method for decoding an event straight from its bytes (with orjson when it is installed)
+def decode_event(event):
+    return json_loads(b''.join(event.body))
+
+# Processing pipeline of one partition: receive -> parse -> batch -> upload -> checkpoint
+#
+# The stages run as separate tasks connected by bounded queues. Up to MAX_CONCURRENT_UPLOADS batches are uploaded at the same
+# time while the checkpoint stage waits for the uploads in the order they were started, so the checkpoint only moves forward in
+# offset order. When uploads are slow or throttled the queues fill up and on_event_batch waits, which stops the receive loop
+# from taking more events instead of buffering them without limit.
+class PartitionPipeline:
+    def __init__(self, sink, project, partition_context, stop):
+        self.sink = sink
+        self.project = project
+        self.partition_context = partition_context
+        self.stop = stop # Future set to the exit code of the receiver to stop it (2 when the events do not have the required columns)
+        self.failed = False # True once a stage ended with an error
+        self.columns_checked = False
+        self.received = asyncio.Queue(PIPELINE_QUEUE_SIZE) # Lists of events from the receive loop
+        self.parsed = asyncio.Queue(PIPELINE_QUEUE_SIZE) # Lists of (log, event) pairs, log is None for events that can not be converted
+        self.batches = asyncio.Queue(PIPELINE_QUEUE_SIZE) # Upload batches of up to MAX_BATCH_SIZE (log, event) pairs
+        self.uploads = asyncio.Queue(PIPELINE_QUEUE_SIZE) # Upload tasks in the order they were started
+        self.upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+        self.pending_event = None # Last delivered event that is not checkpointed yet
+        self.held = False # True once a batch was not fully delivered, the checkpoint then stays before its first failed event
+        self.checkpoint_due = None
+        self.checkpointed_sequence_number = None
+        self.first_sequence_number = None
+        self.checkpoint_writes = 0
+        self.max_replay_window = 0
+        self.tasks = [asyncio.create_task(stage(), name=stage.__name__) for stage in [self.parse_stage, self.batch_stage, self.upload_stage, self.checkpoint_stage]]
+        for task in self.tasks:
+            task.add_done_callback(self.stage_done)
+
+    # A stage that ends with an error would leave the other stages and on_event_batch waiting on full queues forever, so the
+    # error is logged, the other stages are cancelled and the receiver is stopped with exit code 1 (the supervisor restarts it
+    # and the partition is read again from its last checkpoint)
+    def stage_done(self, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        print(f"Partition {self.partition_context.partition_id}: the {task.get_name()} stage failed: {task.exception()!r}. Stopping the receiver.")
+        self.failed = True
+        for other in self.tasks:
+            other.cancel()
+        # Release an on_event_batch that waits for room in the queue, the dropped events are not checkpointed
+        while not self.received.empty():
+            self.received.get_nowait()
+        if not self.stop.done():
+            self.stop.set_result(1)
+
+    async def parse_stage(self):
+        project = self.project
+        while (events := await self.received.get()) is not None:
+            if not self.columns_checked and self.check_columns(events) and not self.stop.done():
+                self.stop.set_result(2)
+            if self.stop.done():
+                # The receiver is stopping, the events are not passed on so they are not checkpointed and are read again
+                continue
+            if self.first_sequence_number is None:
+                self.first_sequence_number = events[0].sequence_number
+            pairs = []
+            for event in events:
+                try:
+                    pairs.append((project(decode_event(event)), event))
+                except (ValueError, KeyError, TypeError) as e:
+                    # An event that can not be converted will never succeed, so it is skipped and checkpointed with the rest of the batch
+                    print(f"Skipping event {event.sequence_number} from partition {self.partition_context.partition_id}: {e!r}")
+                    pairs.append((None, event))
+            await self.parsed.put(pairs)
+        await self.parsed.put(None)
+
+    # Check that the first event that can be decoded has the fields of every required column, returns the missing fields.
+    # Otherwise every event would be skipped and checkpointed, e.g. when the stream declaration has a column the events lack.
+    # Events that can not be decoded are left to parse_stage, which skips them like any other event it can not convert.
+    def check_columns(self, events):
+        for event in events:
+            try:
+                data = decode_event(event)
+            except (ValueError, KeyError, TypeError):
+                continue
+            if not isinstance(data, dict):
+                continue
+            self.columns_checked = True
+            missing = [field for field in self.project.required_fields if field not in data]
+            if missing:
+                print(f"Events of partition {self.partition_context.partition_id} do not have the fields {missing} of required columns of {LOGS_DCR_STREAM_NAME}, "
+                      "add them to OPTIONAL_COLUMNS or FIELD_RENAMES. Stopping the receiver without checkpointing.")
+            return missing
+        return []
+
+    # Combine the received events into batches of MAX_BATCH_SIZE, a smaller batch is sent once it waited MAX_WAIT_TIME seconds
+    async def batch_stage(self):
+        batch = []
+        while True:
+            try:
+                timeout = max(flush_at - time.monotonic(), 0) if batch else None
+                pairs = await asyncio.wait_for(self.parsed.get(), timeout)
+            except asyncio.TimeoutError:
+                pairs = []
+            if pairs is None:
+                break
+            if not batch:
+                flush_at = time.monotonic() + MAX_WAIT_TIME
+            batch.extend(pairs)
+            while len(batch) >= MAX_BATCH_SIZE:
+                await self.batches.put(batch[:MAX_BATCH_SIZE])
+                batch = batch[MAX_BATCH_SIZE:]
+                flush_at = time.monotonic() + MAX_WAIT_TIME
+            if batch and time.monotonic() >= flush_at:
+                await self.batches.put(batch)
+                batch = []
+        if batch:
+            await self.batches.put(batch)
+        await self.batches.put(None)
+
+    async def upload_stage(self):
+        while (batch := await self.batches.get()) is not None:
+            await self.sink.wait_if_throttled()
+            await self.upload_slots.acquire()
+            await self.uploads.put(asyncio.create_task(self.upload(batch)))
+        await self.uploads.put(None)
+
+    # Upload one batch, returns the last event before the first one that failed to upload (None when the first one failed) and
+    # whether every event of the batch was delivered
+    async def upload(self, batch):
+        try:
+            logs = [log for log, event in batch if log is not None]
+            failed_logs = await self.sink.send(logs) if logs else []
+        finally:
+            self.upload_slots.release()
+
+        delivered = len(batch)
+        if failed_logs:
+            failed = {id(log) for log in failed_logs}
+            delivered = next(index for index, (log, event) in enumerate(batch) if id(log) in failed)
+        metrics.events += delivered
+        return (batch[delivered - 1][1] if delivered > 0 else None), not failed_logs
+
+    # Keep the last event that is safe to checkpoint and write it according to the checkpoint policy, the events delivered
+    # after the last written checkpoint (the replay window) are the events that would be processed again after a crash.
+    # Once a batch was not fully delivered, the checkpoint is held before its first failed event until the receiver restarts,
+    # so the failed events are read again. The batches after it are still uploaded (and sent again after the restart).
+    async def checkpoint_stage(self):
+        while True:
+            try:
+                timeout = max(self.checkpoint_due - time.monotonic(), 0) if self.pending_event is not None and CHECKPOINT_EVERY_SECONDS else None
+                upload = await asyncio.wait_for(self.uploads.get(), timeout)
+            except asyncio.TimeoutError:
+                await self.checkpoint()
+                continue
+            if upload is None:
+                break
+            try:
+                event, delivered = await upload
+            except Exception as e:
+                print(f"Error processing events: {e}")
+                event, delivered = None, False
+            if self.held:
+                continue
+            if event is not None:
+                if self.pending_event is None:
+                    self.checkpoint_due = time.monotonic() + (CHECKPOINT_EVERY_SECONDS or 0)
+                self.pending_event = event
+                self.max_replay_window = max(self.max_replay_window, self.replay_window())
+            if not delivered:
+                self.held = True
+                safe_event = self.pending_event.sequence_number if self.pending_event is not None else self.checkpointed_sequence_number
+                print(f"Partition {self.partition_context.partition_id}: events were not delivered, the checkpoint is held at sequence number {safe_event} until the receiver restarts")
+                continue
+            if event is None:
+                continue
+            if CHECKPOINT_EVERY_EVENTS and self.replay_window() >= CHECKPOINT_EVERY_EVENTS or \
+               CHECKPOINT_EVERY_SECONDS and time.monotonic() >= self.checkpoint_due:
+                await self.checkpoint()
+        # Flush the last safe event on shutdown or when the partition was taken over
+        await self.checkpoint()
+        print(f"Partition {self.partition_context.partition_id}: {self.checkpoint_writes} checkpoint writes, largest replay window {self.max_replay_window} events")
+
+    # Number of delivered events that are not covered by the last written checkpoint
+    def replay_window(self):
+        if self.pending_event is None:
+            return 0
+        if self.checkpointed_sequence_number is None:
+            return self.pending_event.sequence_number - self.first_sequence_number + 1
+        return self.pending_event.sequence_number - self.checkpointed_sequence_number
+
+    async def checkpoint(self):
+        if self.pending_event is None:
+            return
+        event = self.pending_event
+        replay_window = self.replay_window()
+        try:
+            # Update the checkpoint so that the program doesn't read the events that it has already read when you run it next time.
+            # (logs after a failed log that were uploaded successfully are sent again, delivery is at least once)
+            await self.partition_context.update_checkpoint(event)
+        except Exception as e:
+            print(f"Error updating checkpoint: {e}")
+            self.checkpoint_due = time.monotonic() + (CHECKPOINT_EVERY_SECONDS or 0)
+            return
+        self.checkpoint_writes += 1
+        self.checkpointed_sequence_number = event.sequence_number
+        if self.pending_event is event:
+            self.pending_event = None
+        print(f"Checkpoint partition {self.partition_context.partition_id} at sequence number {event.sequence_number}, replay window was {replay_window} events - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+
+    # Finish the events already received (upload the last partial batch and update the checkpoint) and stop the stages
+    async def close(self):
+        if not self.failed:
+            await self.received.put(None)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+# Throughput and lag of this receiver process, reported every METRICS_INTERVAL seconds
+class ReceiverMetrics:
+    def __init__(self):
+        self.events = 0 # Events delivered to Log Analytics since the last report
+        self.requests = 0 # Upload requests, logs and uncompressed and compressed bytes sent since the last report
+        self.logs = 0
+        self.json_bytes = 0
+        self.sent_bytes = 0
+        self.spooled = 0 # Logs written to the spool and spooled requests replayed since the last report
+        self.replayed = 0
+        self.lag = {} # Partition ID to the number of events in the partition that were not received yet
+        self.reported_at = time.monotonic()
+
+    def add_request(self, logs, json_bytes, sent_bytes):
+        self.requests += 1
+        self.logs += logs
+        self.json_bytes += json_bytes
+        self.sent_bytes += sent_bytes
+
+    def report(self):
+        now = time.monotonic()
+        report = {'events': self.events, 'seconds': now - self.reported_at, 'partitions': sorted(self.lag), 'lag': sum(self.lag.values()),
+                  'requests': self.requests, 'logs': self.logs, 'json_bytes': self.json_bytes, 'sent_bytes': self.sent_bytes,
+                  'spooled': self.spooled, 'replayed': self.replayed}
+        self.events = self.requests = self.logs = self.json_bytes = self.sent_bytes = self.spooled = self.replayed = 0
+        self.reported_at = now
+        return report
+
+metrics = ReceiverMetrics()
+
+# Requests avoided are counted against sending one request per log
+def format_report(report):
+    return (f"{report['events'] / max(report['seconds'], 0.001):.0f} events/s, {len(report['partitions'])} partitions, lag {report['lag']} events, "
+            f"{report['requests']} requests ({report['logs'] - report['requests']} avoided), "
+            f"{(report['json_bytes'] - report['sent_bytes']) / 1048576:.1f} MB saved by compression, "
+            f"{report['spooled']} logs spooled, {report['replayed']} spooled requests replayed, {report['spool_bytes'] / 1048576:.1f} MB in the spool")
+
+# Function/Method for reporting the metrics of this process, printed or sent to the supervisor when running as a worker
+async def report_metrics(sink, worker_id, metrics_queue):
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        report = metrics.report()
+        report['spool_bytes'] = sink.spool.size
+        if metrics_queue is None:
+            print("Metrics: " + format_report(report) + " - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+        else:
+            metrics_queue.put((worker_id, report))
+
+# Function/Method for starting the pipeline of a partition when this receiver starts reading it
+async def on_partition_initialize(sink, project, stop, pipelines, partition_context):
+    pipelines[partition_context.partition_id] = PartitionPipeline(sink, project, partition_context, stop)
+
+# Function/Method for passing each batch of incoming events to the pipeline of its partition, waits while the pipeline is full
+async def on_event_batch(pipelines, partition_context, events):
+    if not events:
+        return
+    print(f"Received {len(events)} events from partition {partition_context.partition_id} - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+    # Number of events in the partition that were not received yet
+    last_enqueued = partition_context.last_enqueued_event_properties
+    if last_enqueued:
+        metrics.lag[partition_context.partition_id] = last_enqueued['sequence_number'] - events[-1].sequence_number
+    pipeline = pipelines[partition_context.partition_id]
+    if pipeline.failed:
+        # The receiver is stopping, the events are read again from the checkpoint after the restart
+        return
+    await pipeline.received.put(events)
+
+# Function/Method for stopping the pipeline of a partition on shutdown or when another receiver took the partition over
+async def on_partition_close(pipelines, partition_context, reason):
+    metrics.lag.pop(partition_context.partition_id, None)
+    pipeline = pipelines.pop(partition_context.partition_id, None)
+    if pipeline is not None:
+        await pipeline.close()
+
+async def main(worker_id=None, metrics_queue=None):
+    # Compile the conversion of events into Log Analytics logs once for every partition
+    columns = load_stream_columns()
+    project = compile_projector(columns)
+    print(f"Mapping events to the {len(columns)} columns of {LOGS_DCR_STREAM_NAME}, decoding with {json_loads.__module__}")
+
     # Create an Azure blob checkpoint store to store the checkpoints.
     print("Create checkpoint store - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
     checkpoint_store = BlobCheckpointStore.from_connection_string(
@@ -135,13 +675,86 @@ async def main():
     print("Done create Event Hub client store - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
     print("Call the receive event - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
 
-    async with client:
+    # Create the Log Analytics ingestion sink shared by every partition. The sink is closed after the client, because closing the
+    # client closes the partitions, which upload their last partial batch and write their checkpoint through the sink
+    async with LogsIngestionSink(os.path.join(SPOOL_DIR, f"worker-{worker_id or 0}")) as sink, client:
+        # Pipelines of the partitions this receiver is reading
+        pipelines = {}
+        # Set by a pipeline to the exit code of the receiver: 2 when the events do not have the required columns, 1 when a stage failed
+        stop = asyncio.get_running_loop().create_future()
+        reporter = asyncio.create_task(report_metrics(sink, worker_id, metrics_queue))
         # Call the receive method. Read from the beginning of the partition (starting_position: "-1")
-        await client.receive(on_event=on_event, starting_position="-1")
+        receiving = asyncio.create_task(client.receive_batch(
+            on_event_batch=functools.partial(on_event_batch, pipelines),
+            on_partition_initialize=functools.partial(on_partition_initialize, sink, project, stop, pipelines),
+            on_partition_close=functools.partial(on_partition_close, pipelines),
+            max_batch_size=MAX_BATCH_SIZE,
+            max_wait_time=MAX_WAIT_TIME,
+            starting_position="-1",
+            track_last_enqueued_event_properties=True,
+        ))
+        await asyncio.wait([receiving, stop], return_when=asyncio.FIRST_COMPLETED)
+        if stop.done():
+            # Closing the client ends receive_batch and closes the partitions
+            await client.close()
+        await receiving
+        reporter.cancel()
         print("Done Call the receive event - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
 
+    if stop.done():
+        # Exit code 2 tells the supervisor not to restart the worker, the configuration has to be fixed first. A worker that
+        # exits with code 1 after a failed stage is restarted
+        raise SystemExit(stop.result())
+
+# Function/Method run by each worker process started by the supervisor
+def run_worker(worker_id, metrics_queue):
+    asyncio.run(main(worker_id, metrics_queue))
+
+# Function/Method for starting WORKER_PROCESSES receiver processes and printing their combined metrics. Every worker joins the
+# same consumer group with the same checkpoint store, so the partitions are balanced across the workers through the partition
+# ownership kept in the checkpoint store, and a worker that exits is restarted.
+def supervise():
+    context = multiprocessing.get_context('spawn')
+    metrics_queue = context.Queue()
+    workers = {}
+    reports = {}
+    try:
+        while True:
+            for worker_id in range(WORKER_PROCESSES):
+                if worker_id not in workers or not workers[worker_id].is_alive():
+                    if worker_id in workers:
+                        if workers[worker_id].exitcode == 2:
+                            raise SystemExit(f"Worker {worker_id} stopped because the events do not have the required columns of {LOGS_DCR_STREAM_NAME}")
+                        print(f"Worker {worker_id} exited with code {workers[worker_id].exitcode}, restarting")
+                    workers[worker_id] = context.Process(target=run_worker, args=(worker_id, metrics_queue), daemon=True)
+                    workers[worker_id].start()
+
+            try:
+                worker_id, report = metrics_queue.get(timeout=METRICS_INTERVAL)
+                reports[worker_id] = report
+            except queue.Empty:
+                continue
+
+            # Print the metrics once every running worker reported for this interval
+            if len(reports) == len(workers):
+                for worker_id in sorted(reports):
+                    print(f"Worker {worker_id}: " + format_report(reports[worker_id]))
+                total = {key: sum(report[key] for report in reports.values()) for key in ['events', 'lag', 'requests', 'logs', 'json_bytes', 'sent_bytes', 'spooled', 'replayed', 'spool_bytes']}
+                total['seconds'] = max(report['seconds'] for report in reports.values())
+                total['partitions'] = [partition for report in reports.values() for partition in report['partitions']]
+                print("Total: " + format_report(total) + " - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+                reports = {}
+    except KeyboardInterrupt:
+        # The workers received the interrupt as well, wait for them to close their partitions and flush their checkpoints
+        for process in workers.values():
+            process.join()
+
 if __name__ == "__main__":
-    print("Looping - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
-    loop = asyncio.get_event_loop()
-    # Run the main method.
-    loop.run_until_complete(main())
+    if WORKER_PROCESSES > 1:
+        print(f"Starting {WORKER_PROCESSES} worker processes - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+        supervise()
+    else:
+        print("Looping - " + datetime.now().strftime("%H:%M:%S")) # Output to console for status and troubleshooting
+        loop = asyncio.get_event_loop()
+        # Run the main method.
+        loop.run_until_complete(main())
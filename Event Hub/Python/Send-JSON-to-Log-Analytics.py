@@ -1,10 +1,38 @@
 # The purpose of this Python script is to send a JSON payload to a Data Collection Point and Data Collection Rule
 # to ingest the data into a Log Analytics Workspace custom table
+#
+# The logs are packed into gzip-compressed requests of up to UPLOAD_MAX_BYTES of JSON
+#
+# To bulk ingest archived logs (e.g. to backfill months of APIM logs), pass one or more files on the command line:
+#
+# python Send-JSON-to-Log-Analytics.py apim-logs-2023-11.ndjson.gz apim-logs-2023-12.json
+#
+# Each file can contain one JSON object per line (NDJSON) or a JSON array of objects, and can be gzip-compressed (.gz).
+# The files are streamed, so they can be of any size, and the requests are uploaded by MAX_CONCURRENT_UPLOADS concurrent
+# uploads. The rate is printed every REPORT_INTERVAL seconds and the logs of requests that failed are written to
+# FAILED_LOGS_FILE as NDJSON so they can be sent again. Without files the sample log in the body variable is sent.
 
-from azure.core.exceptions import HttpResponseError
-from azure.identity import ClientSecretCredential
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from azure.core.exceptions import AzureError
+from azure.identity.aio import ClientSecretCredential
 from azure.monitor.ingestion.aio import LogsIngestionClient
 
+# orjson decodes and encodes JSON faster than the json module when it is installed (pip install orjson)
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
 # Variables for App Registration authentication
 AZURE_TENANT_ID="#########-####-####-####-############"
 AZURE_CLIENT_ID="#########-####-####-####-############"
@@ -15,20 +43,148 @@ DATA_COLLECTION_ENDPOINT="https://contoso-dev-apim-dcep-3hal.canadaeast-1.ingest
 LOGS_DCR_RULE_ID="dcr-##################################" # Data Collection Rule "immutableId"
 LOGS_DCR_STREAM_NAME="Custom-APIMOpenAILogs_CL" # Data Collection Rule "streamDeclarations"
 
-# Import required modules
-from azure.monitor.ingestion import LogsIngestionClient
-from azure.core.exceptions import HttpResponseError
+# Variables for packing the logs into requests
+UPLOAD_MAX_BYTES = 1000000 # Maximum size of the uncompressed JSON sent in one request, the Logs Ingestion API accepts up to 1 MB per request
+GZIP_LEVEL = 6 # gzip compression level of the request bodies (1 is fastest, 9 is smallest)
+
+# Variables for bulk ingestion
+MAX_CONCURRENT_UPLOADS = 16 # Maximum number of requests being uploaded at the same time
+REPORT_INTERVAL = 5 # Number of seconds between rate reports
+READ_SIZE = 1048576 # Number of characters read from a JSON array file at a time
+FAILED_LOGS_FILE = 'Failed-Logs-{timestamp}.ndjson' # Logs of the requests that failed to upload, one JSON object per line
+
+# Generator that packs logs into gzip-compressed JSON arrays of up to UPLOAD_MAX_BYTES uncompressed bytes,
+# yields (compressed request body, logs in the request, uncompressed size). A log larger than the limit is sent on its own.
+def pack_logs(logs):
+    chunk = []
+    encoded = []
+    size = 2
+    for log in logs:
+        data = json_dumps(log)
+        if chunk and size + len(data) + 1 > UPLOAD_MAX_BYTES:
+            yield gzip.compress(b'[' + b','.join(encoded) + b']', GZIP_LEVEL), chunk, size
+            chunk = []
+            encoded = []
+            size = 2
+        chunk.append(log)
+        encoded.append(data)
+        size += len(data) + (1 if len(chunk) > 1 else 0)
+    if chunk:
+        yield gzip.compress(b'[' + b','.join(encoded) + b']', GZIP_LEVEL), chunk, size
+
+# Generator that yields the objects of a JSON array file one at a time, reading READ_SIZE characters at a time
+def iter_json_array(file):
+    decoder = json.JSONDecoder()
+    buffer = file.read(READ_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("The file does not contain a JSON array")
+    position = 1
+    while True:
+        # Skip the whitespace and comma before the next object
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            log, position = decoder.raw_decode(buffer, position)
+            yield log
+        except json.JSONDecodeError:
+            # The object continues past the end of the buffer, read more of the file
+            chunk = file.read(READ_SIZE)
+            if not chunk:
+                raise
+            buffer = buffer[position:] + chunk
+            position = 0
+
+# Generator that yields the logs of an NDJSON or JSON array file, gzip-compressed or not
+def iter_file(path):
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == b'\x1f\x8b'
+    with (gzip.open(path, 'rt', encoding='utf-8') if compressed else open(path, 'r', encoding='utf-8')) as file:
+        first = file.read(1)
+        while first.isspace():
+            first = file.read(1)
+        file.seek(0)
+        if first == '[':
+            yield from iter_json_array(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json_loads(line)
+
+# Upload totals, printed every REPORT_INTERVAL seconds while the logs are sent
+class UploadStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.logs = 0
+        self.requests = 0
+        self.json_bytes = 0
+        self.sent_bytes = 0
+        self.failed_logs = 0
 
-print("Getting credential")
- # Configure authentication to App Registration credential object
-credential = ClientSecretCredential(tenant_id=AZURE_TENANT_ID,client_id=AZURE_CLIENT_ID,client_secret=AZURE_CLIENT_SECRET)
-print("Done getting credential")
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        return (f"{self.logs} logs in {self.requests} requests ({self.logs / elapsed:.0f} logs/s, {self.json_bytes / 1048576 / elapsed:.1f} MB/s of JSON), "
+                f"{self.json_bytes} bytes of JSON compressed to {self.sent_bytes} bytes ({self.json_bytes - self.sent_bytes} saved), "
+                f"{self.failed_logs} logs failed")
 
-print("Creating client for Log Ingestion")
-# Configure log ingestion object
-client = LogsIngestionClient(endpoint=DATA_COLLECTION_ENDPOINT, credential=credential, logging_enable=True)
-print("Done creating client for Log Ingestion")
+async def report(stats):
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        print("Sent " + stats.summary())
 
+# Function/Method for uploading the logs with up to MAX_CONCURRENT_UPLOADS concurrent requests. The logs are packed into
+# requests in a worker thread so reading and compressing the next request overlaps with the uploads in flight.
+async def send_logs(logs):
+    stats = UploadStats()
+    upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    uploads = set()
+
+    async def upload(client, data, chunk, size, failed_file):
+        try:
+            await client.upload(rule_id=LOGS_DCR_RULE_ID, stream_name=LOGS_DCR_STREAM_NAME, logs=io.BytesIO(data), content_encoding="gzip")
+            stats.logs += len(chunk)
+            stats.requests += 1
+            stats.json_bytes += size
+            stats.sent_bytes += len(data)
+        except AzureError as e:
+            print(f"Upload failed: {e}")
+            stats.failed_logs += len(chunk)
+            failed_file.writelines(json.dumps(log) + '\n' for log in chunk)
+        finally:
+            upload_slots.release()
+
+    print("Getting credential")
+    # Configure authentication to App Registration credential object and log ingestion object
+    credential = ClientSecretCredential(tenant_id=AZURE_TENANT_ID,client_id=AZURE_CLIENT_ID,client_secret=AZURE_CLIENT_SECRET)
+    client = LogsIngestionClient(endpoint=DATA_COLLECTION_ENDPOINT, credential=credential, logging_enable=True)
+    print("Done creating client for Log Ingestion")
+
+    reporter = asyncio.create_task(report(stats))
+    chunks = pack_logs(logs)
+    failed_logs_file = FAILED_LOGS_FILE.format(timestamp=datetime.now().strftime("%Y%m%d-%H%M%S"))
+    async with credential, client:
+        with open(failed_logs_file, 'w') as failed_file:
+            print("Start upload")
+            while (request := await asyncio.to_thread(next, chunks, None)) is not None:
+                await upload_slots.acquire()
+                task = asyncio.create_task(upload(client, *request, failed_file))
+                uploads.add(task)
+                task.add_done_callback(uploads.discard)
+            await asyncio.gather(*uploads)
+            print("Done upload")
+    reporter.cancel()
+
+    # Requests avoided are counted against sending one request per log
+    print("Sent " + stats.summary())
+    print(f"{stats.logs - stats.requests} requests avoided compared to one request per log")
+    if stats.failed_logs:
+        print(f"The logs that failed were written to {failed_logs_file}, send that file again to retry them")
+    else:
+        os.remove(failed_logs_file)
+    return stats
+
+# Sample log sent when no files are given
 body = [
         {
     "EventTime": "11/24/2023 8:19:57 PM",
@@ -58,11 +214,20 @@ body = [
     }
     ]
 
-try:
-    print("Start upload")
-    client.upload(rule_id=LOGS_DCR_RULE_ID, stream_name=LOGS_DCR_STREAM_NAME, logs=body)
-    print("Done upload")
-except HttpResponseError as e:
-    print(f"Upload failed: {e}")
+# Generator that yields the logs of every file in order
+def iter_files(paths):
+    for path in paths:
+        print(f"Reading {path}")
+        yield from iter_file(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send JSON logs to a Log Analytics custom table through a Data Collection Rule")
+    parser.add_argument('files', nargs='*', help="NDJSON or JSON array files to send, optionally gzip-compressed (the sample body is sent when no files are given)")
+    args = parser.parse_args()
+    for path in args.files:
+        if not os.path.exists(path):
+            raise SystemExit(f"The file '{path}' does not exist.")
 
-credential.close() 
+    stats = asyncio.run(send_logs(iter_files(args.files) if args.files else body))
+    if stats.failed_logs:
+        sys.exit(1)
@@ -5,6 +5,8 @@
 
 import azure.functions as func
 import logging
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 
@@ -21,6 +23,9 @@ def setblobmetadatafunc(req: func.HttpRequest) -> func.HttpResponse:
         container_name = req_body.get('container_name')
         blob_path = req_body.get('blob_path', "")
         blob_file_name = req_body.get('blob_file_name')
+        # Optional: only set the metadata if the blob still has this etag, and read the metadata back after setting it
+        etag = req_body.get('etag')
+        verify = req_body.get('verify', False)
 
         if not all([storage_account_url, container_name, blob_file_name]):
             return func.HttpResponse(
@@ -61,17 +66,17 @@ def setblobmetadatafunc(req: func.HttpRequest) -> func.HttpResponse:
 
         # Set metadata
         try:
-            set_blob_metadata(container_client, blob_name, metadata)
+            set_blob_metadata(container_client, blob_name, metadata, etag)
             logging.info(f"Metadata set successfully for blob '{blob_name}'.")
-
-            # Confirm metadata was set
-            blob_client = container_client.get_blob_client(blob_name)
-            properties = blob_client.get_blob_properties()
-            logging.info("Metadata for blob: %s", properties.metadata)
-
+        except ResourceNotFoundError:
+            return func.HttpResponse(
+                f"The blob '{blob_name}' does not exist.",
+                status_code=404
+            )
+        except ResourceModifiedError:
             return func.HttpResponse(
-                f"Metadata set successfully for blob '{blob_name}'.",
-                status_code=200
+                f"The blob '{blob_name}' was changed since etag {etag} was read, its metadata was not set.",
+                status_code=412
             )
         except Exception as e:
             logging.error(f"Failed to set metadata: {e}")
@@ -80,6 +85,24 @@ def setblobmetadatafunc(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=500
             )
 
+        # Confirm metadata was set, a failed read back does not undo the metadata that was set
+        if verify:
+            try:
+                blob_client = container_client.get_blob_client(blob_name)
+                properties = blob_client.get_blob_properties()
+                logging.info("Metadata for blob: %s", properties.metadata)
+            except Exception as e:
+                logging.warning(f"The metadata of blob '{blob_name}' was set, but it could not be read back to verify it: {e}")
+                return func.HttpResponse(
+                    f"Metadata set successfully for blob '{blob_name}', but it could not be read back to verify it: {e}",
+                    status_code=200
+                )
+
+        return func.HttpResponse(
+            f"Metadata set successfully for blob '{blob_name}'.",
+            status_code=200
+        )
+
     except Exception as e:
         logging.error(f"Error: {e}")
         return func.HttpResponse(
@@ -87,22 +110,25 @@ def setblobmetadatafunc(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500
         )
 
-def set_blob_metadata(container_client, blob_name, metadata):
+# The set request fails with 404 when the blob does not exist, so the blob is not checked beforehand. With an etag the
+# metadata is only set if the blob was not changed since the etag was read (412 otherwise)
+def set_blob_metadata(container_client, blob_name, metadata, etag=None):
     # Get blob client
     blob_client = container_client.get_blob_client(blob_name)
 
-    # Check if the blob exists
-    try:
-        blob_client.get_blob_properties()
-        logging.info(f"The blob '{blob_name}' exists.")
-    except Exception as e:
-        logging.error(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
-        raise e  # Raise the exception to be caught in the outer function
-
     # Set metadata
     try:
-        blob_client.set_blob_metadata(metadata)
+        if etag:
+            blob_client.set_blob_metadata(metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+        else:
+            blob_client.set_blob_metadata(metadata)
         logging.info(f"Metadata set successfully for blob '{blob_name}'.")
+    except ResourceNotFoundError as e:
+        logging.error(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
+        raise e  # Raise the exception to be caught
+    except ResourceModifiedError as e:
+        logging.error(f"The blob '{blob_name}' was changed since etag {etag} was read.")
+        raise e  # Raise the exception to be caught
     except Exception as e:
         logging.error(f"Failed to set metadata: {e}")
         raise e  # Raise the exception to be caught
@@ -1,84 +1,73 @@
 import azure.functions as func
+import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
+# Maximum number of blobs in a batch request and the number of blobs of a batch processed at the same time
+max_batch_size = 1000
+max_batch_workers = 32
+
+# Keys of a blob spec that are not custom metadata
+spec_keys = ['storage_account_url', 'container_name', 'blob_path', 'blob_file_name', 'etag', 'verify']
+
+# One credential and one BlobServiceClient per storage account, reused by every blob and by later invocations of a warm instance
+credential = None
+blob_service_clients = {}
+clients_lock = threading.Lock()
+
 @app.route(route="setblobmetadatafunc")
 def setblobmetadatafunc(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
     try:
-        # Parse request parameters
-        req_body = req.get_json()
-        storage_account_url = req_body.get('storage_account_url')
-        container_name = req_body.get('container_name')
-        blob_path = req_body.get('blob_path', "")
-        blob_file_name = req_body.get('blob_file_name')
-
-        if not all([storage_account_url, container_name, blob_file_name]):
+        # Parse the request body: a single blob spec (JSON object), a batch of blob specs (JSON array) or NDJSON (one blob
+        # spec per line)
+        try:
+            body = req.get_body().decode('utf-8')
+        except UnicodeDecodeError:
+            return func.HttpResponse("The request body must be UTF-8 encoded JSON or NDJSON", status_code=400)
+        try:
+            req_body = json.loads(body)
+        except ValueError:
+            try:
+                req_body = [json.loads(line) for line in body.splitlines() if line.strip()]
+            except ValueError:
+                req_body = None
+
+        if isinstance(req_body, dict):
+            status_code, message = set_spec_metadata(req_body)
+            return func.HttpResponse(message, status_code=status_code)
+
+        # An empty body, an empty array or a body of blank lines is an empty batch, it is rejected like an invalid or oversized one
+        if not isinstance(req_body, list) or not req_body or len(req_body) > max_batch_size:
             return func.HttpResponse(
-                "Please pass storage_account_url, container_name, and blob_file_name in the request body",
+                f"Please pass a blob spec, a JSON array or NDJSON of 1 to {max_batch_size} blob specs in the request body",
                 status_code=400
             )
 
-        # Construct full blob name, ensuring no double slashes
-        if blob_path and not blob_path.endswith('/'):
-            blob_path += '/'
-        blob_name = f"{blob_path}{blob_file_name}"  # Full path to the blob
-
-        # Determine toplevelfolder
-        if blob_path:
-            toplevelfolder = blob_path.split('/')[0]
-        else:
-            toplevelfolder = "root"
-
-        # Remove trailing slash from folderpath for metadata
-        folderpath_metadata = blob_path.rstrip('/')
-
-        # Metadata to set
-        metadata = {
-            "containername": container_name,
-            "toplevelfolder": toplevelfolder,
-            "folderpath": folderpath_metadata,
-            "filename": blob_file_name
-        }
-
-        # Add additional metadata from the payload
-        for key, value in req_body.items():
-            if key not in metadata and key not in ['storage_account_url', 'container_name', 'blob_path', 'blob_file_name']:
-                metadata[key] = value
-
-        # Create a credential object using the Azure AD credentials
-        credential = DefaultAzureCredential()
+        # Process the blob specs of the batch concurrently, a failed blob does not fail the batch
+        with ThreadPoolExecutor(max_workers=max_batch_workers) as executor:
+            results = list(executor.map(set_spec_metadata, req_body))
+        statuses = [{"index": index, "status": status_code, "message": message} for index, (status_code, message) in enumerate(results)]
+        failed = sum(1 for status in statuses if status["status"] != 200)
+        logging.info(f"Batch of {len(statuses)} blobs processed, {failed} failed.")
 
-        # Authenticate with Azure AD
-        blob_service_client = BlobServiceClient(account_url=storage_account_url, credential=credential)
-
-        # Get container client
-        container_client = blob_service_client.get_container_client(container_name)
-
-        # Set metadata
-        try:
-            set_blob_metadata(container_client, blob_name, metadata)
-            logging.info(f"Metadata set successfully for blob '{blob_name}'.")
-
-            # Confirm metadata was set
-            blob_client = container_client.get_blob_client(blob_name)
-            properties = blob_client.get_blob_properties()
-            logging.info("Metadata for blob: %s", properties.metadata)
-
-            return func.HttpResponse(
-                f"Metadata set successfully for blob '{blob_name}'.",
-                status_code=200
-            )
-        except Exception as e:
-            logging.error(f"Failed to set metadata: {e}")
-            return func.HttpResponse(
-                f"Failed to set metadata: {e}",
-                status_code=500
-            )
+        # 207 Multi-Status when some of the blobs failed, the status of every blob is in the response body
+        return func.HttpResponse(
+            json.dumps(statuses),
+            status_code=207 if failed else 200,
+            mimetype="application/json"
+        )
 
     except Exception as e:
         logging.error(f"Error: {e}")
@@ -87,22 +76,120 @@ def setblobmetadatafunc(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500
         )
 
-def set_blob_metadata(container_client, blob_name, metadata):
-    # Get blob client
-    blob_client = container_client.get_blob_client(blob_name)
+# Function to return the container client of a storage account, creating the credential and BlobServiceClient the first time
+def get_container_client(storage_account_url, container_name):
+    global credential
+    with clients_lock:
+        if storage_account_url not in blob_service_clients:
+            # Create a credential object using the Azure AD credentials
+            if credential is None:
+                credential = DefaultAzureCredential()
+
+            # Authenticate with Azure AD, with a connection pool large enough for every batch worker
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_batch_workers)
+            session.mount('https://', adapter)
+            blob_service_clients[storage_account_url] = BlobServiceClient(account_url=storage_account_url, credential=credential, transport=RequestsTransport(session=session))
+        blob_service_client = blob_service_clients[storage_account_url]
+    return blob_service_client.get_container_client(container_name)
+
+# Function to set the metadata of the blob described by a blob spec, returns the HTTP status code and message for the blob
+# Any error is returned as the status of the blob, so one bad blob spec never fails the rest of a batch
+def set_spec_metadata(req_body):
+    try:
+        return update_spec_metadata(req_body)
+    except Exception as e:
+        logging.error(f"Failed to process blob spec: {e}")
+        return 500, f"Failed to process blob spec: {e}"
+
+# Function to validate a blob spec and set the metadata of its blob, returns the HTTP status code and message for the blob
+def update_spec_metadata(req_body):
+    if not isinstance(req_body, dict):
+        return 400, "Every blob spec must be a JSON object"
+
+    # Parse request parameters
+    storage_account_url = req_body.get('storage_account_url')
+    container_name = req_body.get('container_name')
+    blob_path = req_body.get('blob_path', "")
+    blob_file_name = req_body.get('blob_file_name')
+    # Optional: only set the metadata if the blob still has this etag, and read the metadata back after setting it
+    etag = req_body.get('etag')
+    verify = req_body.get('verify', False)
+
+    if not all([storage_account_url, container_name, blob_file_name]):
+        return 400, "Please pass storage_account_url, container_name, and blob_file_name in the request body"
+    if not all(isinstance(value, str) for value in [storage_account_url, container_name, blob_path, blob_file_name]) or not isinstance(etag, (str, type(None))):
+        return 400, "storage_account_url, container_name, blob_path, blob_file_name and etag must be strings"
+
+    # Construct full blob name, ensuring no double slashes
+    if blob_path and not blob_path.endswith('/'):
+        blob_path += '/'
+    blob_name = f"{blob_path}{blob_file_name}"  # Full path to the blob
+
+    # Determine toplevelfolder
+    if blob_path:
+        toplevelfolder = blob_path.split('/')[0]
+    else:
+        toplevelfolder = "root"
+
+    # Remove trailing slash from folderpath for metadata
+    folderpath_metadata = blob_path.rstrip('/')
+
+    # Metadata to set
+    metadata = {
+        "containername": container_name,
+        "toplevelfolder": toplevelfolder,
+        "folderpath": folderpath_metadata,
+        "filename": blob_file_name
+    }
+
+    # Add additional metadata from the payload
+    for key, value in req_body.items():
+        if key not in metadata and key not in spec_keys:
+            metadata[key] = value
 
-    # Check if the blob exists
+    # Set metadata
     try:
-        blob_client.get_blob_properties()
-        logging.info(f"The blob '{blob_name}' exists.")
+        container_client = get_container_client(storage_account_url, container_name)
+        set_blob_metadata(container_client, blob_name, metadata, etag)
+    except ResourceNotFoundError:
+        return 404, f"The blob '{blob_name}' does not exist."
+    except ResourceModifiedError:
+        return 412, f"The blob '{blob_name}' was changed since etag {etag} was read, its metadata was not set."
     except Exception as e:
-        logging.error(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
-        raise e  # Raise the exception to be caught in the outer function
+        logging.error(f"Failed to set metadata: {e}")
+        return 500, f"Failed to set metadata: {e}"
+
+    # Confirm metadata was set, a failed read back does not undo the metadata that was set
+    if verify:
+        try:
+            properties = container_client.get_blob_client(blob_name).get_blob_properties()
+            logging.info("Metadata for blob: %s", properties.metadata)
+        except Exception as e:
+            logging.warning(f"The metadata of blob '{blob_name}' was set, but it could not be read back to verify it: {e}")
+            return 200, f"Metadata set successfully for blob '{blob_name}', but it could not be read back to verify it: {e}"
+
+    return 200, f"Metadata set successfully for blob '{blob_name}'."
+
+# The set request fails with 404 when the blob does not exist, so the blob is not checked beforehand. With an etag the
+# metadata is only set if the blob was not changed since the etag was read (412 otherwise)
+def set_blob_metadata(container_client, blob_name, metadata, etag=None):
+    # Get blob client
+    blob_client = container_client.get_blob_client(blob_name)
 
     # Set metadata
     try:
-        blob_client.set_blob_metadata(metadata)
+        if etag:
+            blob_client.set_blob_metadata(metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+        else:
+            blob_client.set_blob_metadata(metadata)
         logging.info(f"Metadata set successfully for blob '{blob_name}'.")
+    except ResourceNotFoundError as e:
+        logging.error(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
+        raise e  # Raise the exception to be caught in the outer function
+    except ResourceModifiedError as e:
+        logging.error(f"The blob '{blob_name}' was changed since etag {etag} was read.")
+        raise e  # Raise the exception to be caught in the outer function
     except Exception as e:
         logging.error(f"Failed to set metadata: {e}")
         raise e  # Raise the exception to be caught in the outer function
@@ -0,0 +1,258 @@
+"""
+# Asyncio version of Set-Blob-Metadata_v2.py for tagging large numbers of blobs, reads the same blob_details.json file
+{
+    "storage_account_url": "https://fileuploadtest.blob.core.windows.net/",
+    "container_name": "sharepoint",
+    "prefix": "Shared Documents/Root Folder/",
+    "tag1" : "value1",
+    "tag2" : "value2"
+}
+
+# "prefix" can be replaced with "manifest_file" (a file listing the blob names to tag, one per line) or with "blob_path" and
+# "blob_file_name" for a single blob. To use a connection string instead of Azure AD (e.g. for the Azurite emulator), add:
+    "connection_string": "UseDevelopmentStorage=true"
+
+One credential and one BlobServiceClient are shared by every operation. DefaultAzureCredential signs in from the
+environment, a managed identity or the Azure CLI (az login), so no browser window is opened on every run. Up to
+max_concurrency metadata requests are sent at the same time (limited by a semaphore and a connection pool of the same
+size), and the blobs are listed page by page with their metadata while they are tagged.
+
+Like Set-Blob-Metadata_v2.py, every blob takes one request, the write is conditional on the listed etag, metadata_mode
+chooses between "overwrite" and "merge" and blobs whose existing metadata is known (listed blobs, or any blob in merge mode)
+and already equals the desired metadata are skipped without a write.
+
+Requests throttled by the service (429 and 503), server errors (500, 502 and 504) and connection errors or timeouts are
+retried up to max_retries times by this script rather than by the SDK, waiting for the Retry-After header when the service
+sends one, otherwise for an exponential backoff with full jitter so the concurrent operations do not retry in lockstep.
+
+# Benchmark against the Azurite emulator
+npm install -g azurite
+azurite-blob --silent --location /tmp/azurite
+# Then set "connection_string": "UseDevelopmentStorage=true", "prefix": "bench/" and benchmark_blob_count below (e.g. 100000)
+# in blob_details.json and run this script. The test blobs are uploaded first and the tagging blobs/s is reported at the end,
+# compare it with Set-Blob-Metadata_v2.py on the same blobs and change max_concurrency to find the best value.
+"""
+
+# Install required packages
+# pip install azure-identity azure-storage-blob aiohttp
+
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+import aiohttp
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceModifiedError, ResourceNotFoundError, ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential
+from azure.storage.blob.aio import BlobServiceClient
+
+# Maximum number of metadata requests sent at the same time
+max_concurrency = 512
+
+# Number of seconds between progress reports
+report_interval = 10
+
+# "overwrite" replaces the metadata of every blob, "merge" keeps its existing keys and adds or updates the desired ones
+metadata_mode = "overwrite"
+
+# Retries of a request that was throttled (429 or 503), failed with a server error (500, 502 or 504) or lost its connection,
+# with an exponential backoff of up to max_backoff seconds
+max_retries = 8
+base_backoff = 0.5
+max_backoff = 30
+
+# Number of empty test blobs uploaded under the prefix before tagging them, for benchmarks against Azurite (0 = none)
+benchmark_blob_count = 0
+
+# Keys of blob_details.json that are not custom tags
+detail_keys = ["storage_account_url", "connection_string", "container_name", "blob_path", "blob_file_name", "prefix", "manifest_file", "etag"]
+
+# Function to load blob details and tags from a JSON file
+def load_blob_details(json_file):
+    with open(json_file, 'r') as file:
+        details = json.load(file)
+    return details
+
+# Function to build the full blob name and its metadata from the blob path, file name and custom tags
+def get_blob_metadata(container_name, blob_path, blob_file_name, tags):
+    # Construct full blob name, ensuring no double slashes
+    if blob_path and not blob_path.endswith('/'):
+        blob_path += '/'
+    blob_name = f"{blob_path}{blob_file_name}"  # Full path to the blob
+
+    # Determine toplevelfolder
+    if blob_path:
+        toplevelfolder = blob_path.split('/')[0]
+    else:
+        toplevelfolder = "null"
+
+    # Add additional metadata
+    metadata = dict(tags)
+    metadata.update({
+        "containername": container_name,
+        "toplevelfolder": toplevelfolder,
+        "folderpath": blob_path.rstrip('/'),
+        "filename": blob_file_name
+    })
+    return blob_name, metadata
+
+# Function to return the metadata to write for a blob based on its existing metadata, or None when it already has it
+def get_updated_metadata(existing, metadata):
+    # The service returns every metadata value as a string
+    updated = dict(existing) if metadata_mode == "merge" else {}
+    updated.update({key: str(value) for key, value in metadata.items()})
+    return None if updated == existing else updated
+
+# Status codes of the responses that are retried
+retry_status_codes = (429, 500, 502, 503, 504)
+
+# Function to send a request with the semaphore held, retrying with jitter when it is throttled, fails with a server error or
+# loses its connection (the SDK retries are turned off, so these are the only retries)
+async def with_retry(semaphore, operation, *args, **kwargs):
+    for attempt in range(max_retries + 1):
+        try:
+            async with semaphore:
+                return await operation(*args, **kwargs)
+        except (ServiceRequestError, ServiceResponseError):
+            # The request could not be sent or the connection was reset or timed out before a response was received
+            if attempt == max_retries:
+                raise
+            retry_after = None
+        except HttpResponseError as e:
+            if e.status_code not in retry_status_codes or attempt == max_retries:
+                raise
+            retry_after = e.response.headers.get('Retry-After') if e.response is not None else None
+        # The semaphore is released while waiting so other blobs can use the slot
+        await asyncio.sleep(float(retry_after) if retry_after else random.uniform(0, min(max_backoff, base_backoff * 2 ** attempt)))
+
+# Function to update the metadata of a blob according to metadata_mode with one request, skipping the write when the blob
+# already has the metadata. existing is the metadata of the blob when it is known from a listing. Returns "skipped",
+# "merged" or "overwritten", or None when the update failed
+async def update_blob_metadata(container_client, semaphore, blob_name, metadata, etag=None, existing=None):
+    blob_client = container_client.get_blob_client(blob_name)
+    try:
+        if existing is None and metadata_mode == "merge":
+            # Read the existing metadata to merge with, the write is conditional on the etag that was read with it
+            properties = await with_retry(semaphore, blob_client.get_blob_properties)
+            existing, etag = properties.metadata, properties.etag
+
+        if existing is not None:
+            metadata = get_updated_metadata(existing, metadata)
+            if metadata is None:
+                return "skipped"
+
+        if etag:
+            await with_retry(semaphore, blob_client.set_blob_metadata, metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+        else:
+            await with_retry(semaphore, blob_client.set_blob_metadata, metadata)
+    except ResourceNotFoundError:
+        print(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
+        return None
+    except ResourceModifiedError:
+        print(f"The blob '{blob_name}' was changed since it was read, its metadata was not set.")
+        return None
+    except Exception as e:
+        print(f"Failed to set metadata for blob '{blob_name}': {e}")
+        return None
+    return "merged" if metadata_mode == "merge" else "overwritten"
+
+# Generator that yields the (name, etag, metadata) of the blobs to tag, from the manifest file (without etag and metadata) or
+# by listing the blobs under the prefix with their metadata
+async def iter_blobs(container_client, details):
+    if "manifest_file" in details:
+        with open(details["manifest_file"], 'r') as file:
+            for line in file:
+                if line.strip():
+                    yield line.strip(), None, None
+    else:
+        async for blob in container_client.list_blobs(name_starts_with=details["prefix"], include=['metadata']):
+            yield blob.name, blob.etag, blob.metadata or {}
+
+# Function to upload benchmark_blob_count empty test blobs under the prefix
+async def create_benchmark_blobs(container_client, semaphore, prefix):
+    try:
+        await container_client.create_container()
+    except HttpResponseError:
+        pass  # The container already exists
+    started = time.monotonic()
+    await asyncio.gather(*[with_retry(semaphore, container_client.upload_blob, f"{prefix}Folder{number % 100}/File{number}.txt", b"", overwrite=True)
+                           for number in range(benchmark_blob_count)])
+    print(f"Uploaded {benchmark_blob_count} test blobs in {time.monotonic() - started:.1f} seconds")
+
+# Function to tag every blob with up to max_concurrency requests at the same time
+async def set_bulk_blob_metadata(container_client, semaphore, container_name, blobs, tags):
+    started = time.monotonic()
+    reported = started
+    results = Counter()
+
+    async def tag_blob(blob_name, etag, existing):
+        blob_path, _, blob_file_name = blob_name.rpartition('/')
+        blob_name, metadata = get_blob_metadata(container_name, blob_path, blob_file_name, tags)
+        return await update_blob_metadata(container_client, semaphore, blob_name, metadata, etag, existing)
+
+    def summary():
+        return f"{results['skipped']} skipped, {results['merged']} merged, {results['overwritten']} overwritten, {results[None]} failed"
+
+    pending = set()
+    # Only a few blobs per request slot are queued, so the listing stays just ahead of the requests
+    async for blob_name, etag, existing in blobs:
+        pending.add(asyncio.ensure_future(tag_blob(blob_name, etag, existing)))
+        if len(pending) < max_concurrency * 4:
+            continue
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        results.update(task.result() for task in done)
+        if time.monotonic() - reported >= report_interval:
+            reported = time.monotonic()
+            processed = sum(results.values())
+            print(f"Processed {processed} blobs ({processed / (reported - started):.0f} blobs/s): {summary()}")
+    results.update(await asyncio.gather(*pending))
+
+    elapsed = max(time.monotonic() - started, 0.001)
+    processed = sum(results.values())
+    print(f"Processed {processed} blobs in {elapsed:.1f} seconds ({processed / elapsed:.0f} blobs/s): {summary()}")
+
+async def main():
+    # Load blob details and tags from JSON file
+    json_file = 'blob_details.json'
+    details = load_blob_details(json_file)
+    container_name = details["container_name"]
+
+    # Extract metadata tags
+    tags = {k: v for k, v in details.items() if k not in detail_keys}
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    credential = None
+    # One connection per concurrent request, the default pool of aiohttp only has 100 connections. Throttled and failed
+    # requests are retried by with_retry, so the retries of the SDK are turned off
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_concurrency)) as session:
+        transport = AioHttpTransport(session=session, session_owner=False)
+        if "connection_string" in details:
+            blob_service_client = BlobServiceClient.from_connection_string(details["connection_string"], transport=transport, retry_total=0)
+        else:
+            credential = DefaultAzureCredential()
+            blob_service_client = BlobServiceClient(account_url=details["storage_account_url"], credential=credential, transport=transport, retry_total=0)
+
+        async with blob_service_client:
+            container_client = blob_service_client.get_container_client(container_name)
+
+            if "prefix" in details or "manifest_file" in details:
+                if benchmark_blob_count and "prefix" in details:
+                    await create_benchmark_blobs(container_client, semaphore, details["prefix"])
+                # Set metadata for every blob under the prefix or in the manifest file
+                await set_bulk_blob_metadata(container_client, semaphore, container_name, iter_blobs(container_client, details), tags)
+            else:
+                # Set metadata for the specified blob, only if it still has the etag given in blob_details.json (when there is one)
+                blob_name, metadata = get_blob_metadata(container_name, details.get("blob_path", ""), details["blob_file_name"], tags)
+                result = await update_blob_metadata(container_client, semaphore, blob_name, metadata, details.get("etag"))
+                if result == "skipped":
+                    print(f"The blob '{blob_name}' already has this metadata, nothing was written.")
+                elif result:
+                    print(f"Metadata set successfully for blob '{blob_name}'.")
+
+        if credential:
+            await credential.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
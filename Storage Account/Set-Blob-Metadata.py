@@ -1,6 +1,8 @@
 # Install required packages  
 # pip install azure-identity azure-storage-blob  
   
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
 from azure.identity import InteractiveBrowserCredential  
 from azure.storage.blob import BlobServiceClient  
   
@@ -12,6 +14,8 @@ container_name = "sharepoint"
 
 blob_path = ""  # Path to the blob, empty for root  
 blob_file_name = "New Doc.txt"  # Blob file name  
+blob_etag = None  # ETag of the blob when it was read, the metadata is only set if the blob was not changed since (None sets it unconditionally)
+verify_metadata = False  # Read the metadata back after setting it to confirm it was set (one additional request)
   
 # Construct full blob name, ensuring no double slashes  
 if blob_path and not blob_path.endswith('/'):  
@@ -46,30 +50,40 @@ blob_service_client = BlobServiceClient(account_url=storage_account_url, credent
 # Get container client  
 container_client = blob_service_client.get_container_client(container_name)  
   
-# Function to set metadata  
-def set_blob_metadata(container_client, blob_name, metadata):  
-    # Get blob client  
-    blob_client = container_client.get_blob_client(blob_name)  
-      
-    # Check if the blob exists  
-    try:  
-        blob_client.get_blob_properties()  
-        print(f"The blob '{blob_name}' exists.")  
-    except Exception as e:  
-        print(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")  
-        return  
-      
-    # Set metadata  
-    try:  
-        blob_client.set_blob_metadata(metadata)  
-        print(f"Metadata set successfully for blob '{blob_name}'.")  
-          
-        # Confirm metadata was set  
-        properties = blob_client.get_blob_properties()  
-        print("Metadata for blob:", properties.metadata)  
-    except Exception as e:  
-        print(f"Failed to set metadata: {e}")  
-  
+# Function to set metadata with one request, a blob that does not exist is reported from the 404 of the set request
+def set_blob_metadata(container_client, blob_name, metadata, etag=None, verify=False):
+    # Get blob client
+    blob_client = container_client.get_blob_client(blob_name)
+
+    # Set metadata, only if the blob still has the etag when one is given
+    try:
+        if etag:
+            blob_client.set_blob_metadata(metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+        else:
+            blob_client.set_blob_metadata(metadata)
+        print(f"Metadata set successfully for blob '{blob_name}'.")
+    except ResourceNotFoundError:
+        print(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
+        return
+    except ResourceModifiedError:
+        print(f"The blob '{blob_name}' was changed since it was read, its metadata was not set.")
+        return
+    except Exception as e:
+        print(f"Failed to set metadata: {e}")
+        return
+
+    # Confirm metadata was set
+    if verify:
+        try:
+            properties = blob_client.get_blob_properties()
+        except Exception as e:
+            print(f"The metadata of blob '{blob_name}' was set, but it could not be read back to verify it: {e}")
+            return
+        print("Metadata for blob:", properties.metadata)
+        # The service returns every metadata value as a string
+        if properties.metadata != {key: str(value) for key, value in metadata.items()}:
+            print(f"The metadata of blob '{blob_name}' does not match the metadata that was set.")
+
 # List blobs in the container to ensure the blob exists (commented out for faster execution)  
 # print("Listing blobs in the container:")  
 # blobs_list = container_client.list_blobs()  
@@ -77,4 +91,4 @@ def set_blob_metadata(container_client, blob_name, metadata):
 #     print(f"Blob name: {blob.name}")  
   
 # Set metadata for the specified blob  
-set_blob_metadata(container_client, blob_name, metadata)  
+set_blob_metadata(container_client, blob_name, metadata, blob_etag, verify_metadata)
@@ -9,6 +9,38 @@
     "tag2" : "value2",
     "tag3" : "value3"
 } 
+
+# To tag every blob under a prefix (bulk mode), replace blob_path and blob_file_name with a prefix
+# (use "" for the whole container):
+{
+    "storage_account_url": "https://fileuploadtest.blob.core.windows.net/",
+    "container_name": "sharepoint",
+    "prefix": "Shared Documents/Root Folder/",
+    "tag1" : "value1"
+}
+
+# Or with a manifest file listing the blob names to tag, one per line:
+{
+    "storage_account_url": "https://fileuploadtest.blob.core.windows.net/",
+    "container_name": "sharepoint",
+    "manifest_file": "blob_manifest.txt",
+    "tag1" : "value1"
+}
+
+In bulk mode the blobs are listed page by page as they are tagged, the toplevelfolder, folderpath and filename metadata is
+derived from each blob name and up to max_workers blobs are tagged at the same time. The progress is printed every
+report_interval seconds.
+
+Setting the metadata takes one request per blob: a blob that does not exist is reported from the 404 of the set request,
+and the metadata is only read back for the verify_sample_rate fraction of the blobs. The etag of each listed blob (or the
+optional "etag" in blob_details.json) is sent with the request, so a blob changed in the meantime is not overwritten.
+
+With metadata_mode "overwrite" the metadata of the blob is replaced, with "merge" the existing keys are kept and only the
+tags and the standard keys are added or updated. A blob whose existing metadata is known and already equals the resulting
+metadata is skipped without a write, so re-running a bulk job under a prefix only writes the blobs that changed. The existing
+metadata of the listed blobs is returned by the listing itself. Blobs from a manifest file (and the single blob) are only read
+first in merge mode, so in overwrite mode they are always written (one request, no skip). A summary of the skipped, merged and
+overwritten blobs is printed at the end.
 """
 
 # Additional code added to add custom tags
@@ -17,87 +49,223 @@
 # pip install azure-identity azure-storage-blob  
   
 import json
+import random
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import InteractiveBrowserCredential
 from azure.storage.blob import BlobServiceClient
 
+# Maximum number of blobs tagged at the same time in bulk mode
+max_workers = 64
+
+# Number of seconds between progress reports in bulk mode
+report_interval = 10
+
+# Keys of blob_details.json that are not custom tags
+detail_keys = ["storage_account_url", "container_name", "blob_path", "blob_file_name", "prefix", "manifest_file", "etag"]
+
+# "overwrite" replaces the metadata of every blob, "merge" keeps its existing keys and adds or updates the desired ones
+metadata_mode = "overwrite"
+
+# Fraction of the blobs whose metadata is read back to confirm it was set (0 = none, 1 = every blob), this costs one
+# additional request per verified blob
+verify_sample_rate = 0
+
 # Function to load blob details and tags from a JSON file
 def load_blob_details(json_file):
     with open(json_file, 'r') as file:
         details = json.load(file)
     return details
 
-# Function to set metadata
-def set_blob_metadata(container_client, blob_name, metadata):
-    # Get blob client
-    blob_client = container_client.get_blob_client(blob_name)
-    
-    # Check if the blob exists
-    try:
-        blob_client.get_blob_properties()
-        print(f"The blob '{blob_name}' exists.")
-    except Exception as e:
-        print(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
-        return
-    
-    # Set metadata
-    try:
-        blob_client.set_blob_metadata(metadata)
-        print(f"Metadata set successfully for blob '{blob_name}'.")
-        
-        # Confirm metadata was set
-        properties = blob_client.get_blob_properties()
-        print("Metadata for blob:", properties.metadata)
-    except Exception as e:
-        print(f"Failed to set metadata: {e}")
-
-def main():
-    # Load blob details and tags from JSON file
-    json_file = 'blob_details.json'
-    details = load_blob_details(json_file)
-    
-    storage_account_url = details["storage_account_url"]
-    container_name = details["container_name"]
-    blob_path = details.get("blob_path", "")
-    blob_file_name = details["blob_file_name"]
-    
-    # Extract metadata tags
-    metadata = {k: v for k, v in details.items() if k not in ["storage_account_url", "container_name", "blob_path", "blob_file_name"]}
-    
+# Function to build the full blob name and its metadata from the blob path, file name and custom tags
+def get_blob_metadata(container_name, blob_path, blob_file_name, tags):
     # Construct full blob name, ensuring no double slashes
     if blob_path and not blob_path.endswith('/'):
         blob_path += '/'
     blob_name = f"{blob_path}{blob_file_name}"  # Full path to the blob
-    
+
     # Determine toplevelfolder
     if blob_path:
         toplevelfolder = blob_path.split('/')[0]
     else:
         toplevelfolder = "null"
-    print(f"Determined toplevelfolder: {toplevelfolder}")  # Debug statement
-    
+
     # Remove trailing slash from folderpath for metadata
     folderpath_metadata = blob_path.rstrip('/')
-    print(f"Determined folderpath_metadata: {folderpath_metadata}")  # Debug statement
-    
+
     # Add additional metadata
+    metadata = dict(tags)
     metadata.update({
         "containername": container_name,
         "toplevelfolder": toplevelfolder,
         "folderpath": folderpath_metadata,
         "filename": blob_file_name
     })
+    return blob_name, metadata
+
+# Function to set metadata with one request, returns True when the metadata was set
+#
+# The set request itself fails with 404 when the blob does not exist, so the blob is not checked beforehand. With an etag
+# the metadata is only set if the blob was not changed since the etag was read, so a concurrent update is not overwritten.
+# The metadata is read back to confirm it was set only when verify is True.
+def set_blob_metadata(container_client, blob_name, metadata, etag=None, verify=False):
+    # Get blob client
+    blob_client = container_client.get_blob_client(blob_name)
+    
+    # Set metadata
+    try:
+        if etag:
+            blob_client.set_blob_metadata(metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+        else:
+            blob_client.set_blob_metadata(metadata)
+        print(f"Metadata set successfully for blob '{blob_name}'.")
+    except ResourceNotFoundError:
+        print(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
+        return False
+    except ResourceModifiedError:
+        print(f"The blob '{blob_name}' was changed since it was read, its metadata was not set.")
+        return False
+    except Exception as e:
+        print(f"Failed to set metadata: {e}")
+        return False
+    
+    # Confirm metadata was set
+    if verify:
+        try:
+            properties = blob_client.get_blob_properties()
+        except Exception as e:
+            print(f"The metadata of blob '{blob_name}' was set, but it could not be read back to verify it: {e}")
+            return False
+        print("Metadata for blob:", properties.metadata)
+        # The service returns every metadata value as a string
+        if properties.metadata != {key: str(value) for key, value in metadata.items()}:
+            print(f"The metadata of blob '{blob_name}' does not match the metadata that was set.")
+            return False
+    return True
+
+# Function to return the metadata to write for a blob based on its existing metadata, or None when it already has it
+def get_updated_metadata(existing, metadata):
+    # The service returns every metadata value as a string
+    updated = dict(existing) if metadata_mode == "merge" else {}
+    updated.update({key: str(value) for key, value in metadata.items()})
+    return None if updated == existing else updated
+
+# Function to update the metadata of a blob according to metadata_mode, skipping the write when the blob already has the
+# metadata. existing is the metadata of the blob when it is known from a listing. Returns "skipped", "merged" or
+# "overwritten", or None when the update failed
+def update_blob_metadata(container_client, blob_name, metadata, etag=None, existing=None, verify=False):
+    if existing is None and metadata_mode == "merge":
+        # Read the existing metadata to merge with, the write is conditional on the etag that was read with it
+        try:
+            properties = container_client.get_blob_client(blob_name).get_blob_properties()
+        except ResourceNotFoundError:
+            print(f"The blob '{blob_name}' does not exist. Please check the blob name and try again.")
+            return None
+        except Exception as e:
+            print(f"Failed to read the metadata of blob '{blob_name}': {e}")
+            return None
+        existing, etag = properties.metadata, properties.etag
+
+    if existing is not None:
+        metadata = get_updated_metadata(existing, metadata)
+        if metadata is None:
+            return "skipped"
+
+    if not set_blob_metadata(container_client, blob_name, metadata, etag, verify):
+        return None
+    return "merged" if metadata_mode == "merge" else "overwritten"
+
+# Generator that yields the (name, etag, metadata) of the blobs to tag in bulk mode, from the manifest file (without etag and
+# metadata) or by listing the blobs under the prefix with their metadata, one page at a time (only the current page is kept
+# in memory)
+def iter_blobs(container_client, details):
+    if "manifest_file" in details:
+        with open(details["manifest_file"], 'r') as file:
+            for line in file:
+                if line.strip():
+                    yield line.strip(), None, None
+    else:
+        for page in container_client.list_blobs(name_starts_with=details["prefix"], include=['metadata']).by_page():
+            for blob in page:
+                yield blob.name, blob.etag, blob.metadata or {}
+
+# Function to tag every blob in bulk mode with up to max_workers blobs tagged at the same time
+def set_bulk_blob_metadata(container_client, container_name, blobs, tags):
+    started = time.monotonic()
+    reported = started
+    results = Counter()
+
+    def tag_blob(blob_name, etag, existing):
+        blob_path, _, blob_file_name = blob_name.rpartition('/')
+        blob_name, metadata = get_blob_metadata(container_name, blob_path, blob_file_name, tags)
+        # The listed etag makes sure a blob changed after it was listed is not overwritten, a sample of the blobs is verified
+        return update_blob_metadata(container_client, blob_name, metadata, etag, existing, verify=random.random() < verify_sample_rate)
+
+    def summary():
+        return f"{results['skipped']} skipped, {results['merged']} merged, {results['overwritten']} overwritten, {results[None]} failed"
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        # Only a few blobs per worker are queued, so the listing stays just ahead of the workers
+        for blob_name, etag, existing in blobs:
+            pending.add(executor.submit(tag_blob, blob_name, etag, existing))
+            if len(pending) < max_workers * 4:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            results.update(future.result() for future in done)
+            if time.monotonic() - reported >= report_interval:
+                reported = time.monotonic()
+                processed = sum(results.values())
+                print(f"Processed {processed} blobs ({processed / (reported - started):.0f} blobs/s): {summary()}")
+        results.update(future.result() for future in pending)
+
+    elapsed = max(time.monotonic() - started, 0.001)
+    processed = sum(results.values())
+    print(f"Processed {processed} blobs in {elapsed:.1f} seconds ({processed / elapsed:.0f} blobs/s): {summary()}")
+
+def main():
+    # Load blob details and tags from JSON file
+    json_file = 'blob_details.json'
+    details = load_blob_details(json_file)
+    
+    storage_account_url = details["storage_account_url"]
+    container_name = details["container_name"]
+    
+    # Extract metadata tags
+    tags = {k: v for k, v in details.items() if k not in detail_keys}
     
     # Create a credential object using the Azure AD credentials
     credential = InteractiveBrowserCredential()
     
-    # Authenticate with Azure AD
-    blob_service_client = BlobServiceClient(account_url=storage_account_url, credential=credential)
+    # Authenticate with Azure AD, with a connection pool large enough for every worker in bulk mode
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    blob_service_client = BlobServiceClient(account_url=storage_account_url, credential=credential, transport=RequestsTransport(session=session))
     
     # Get container client
     container_client = blob_service_client.get_container_client(container_name)
     
-    # Set metadata for the specified blob
-    set_blob_metadata(container_client, blob_name, metadata)
+    if "prefix" in details or "manifest_file" in details:
+        # Set metadata for every blob under the prefix or in the manifest file
+        set_bulk_blob_metadata(container_client, container_name, iter_blobs(container_client, details), tags)
+        return
+    
+    blob_name, metadata = get_blob_metadata(container_name, details.get("blob_path", ""), details["blob_file_name"], tags)
+    print(f"Determined toplevelfolder: {metadata['toplevelfolder']}")  # Debug statement
+    print(f"Determined folderpath_metadata: {metadata['folderpath']}")  # Debug statement
+    
+    # Set metadata for the specified blob, only if it still has the etag given in blob_details.json (when there is one)
+    result = update_blob_metadata(container_client, blob_name, metadata, details.get("etag"), verify=verify_sample_rate > 0)
+    if result == "skipped":
+        print(f"The blob '{blob_name}' already has this metadata, nothing was written.")
 
 if __name__ == "__main__":
     main()